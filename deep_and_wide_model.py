@@ -1,5 +1,5 @@
 import os
-import pickle
+import sys
 import time
 
 import keras
@@ -8,46 +8,73 @@ import pandas as pd
 from keras import Sequential
 from keras.layers import Dense, Dropout
 from keras.models import load_model
-from keras.preprocessing import sequence
 from sklearn.metrics import confusion_matrix, classification_report
 from sklearn.model_selection import train_test_split
 
-from gazette_model import process_bad_words
-from lda_model import get_lda_topics, predict_lda_topics
-from lsi_model import build_LSI_model, predict_LSI_model
-from lstm_model import lstm_main, lstm_predict, MAX_VOCAB_SIZE, chunks, MAX_NUM_WORDS_ONE_HOT
-from tf_idf_model import tf_idf_vectorizer_small, tf_idf_vectorizer_big, build_logistic_regression_model
-from utils import COMMENT_TEXT_INDEX, BALANCED_DATA_FILE, transform_text_in_df_return_w2v_np_vectors
-
-IGNORE = 0
-TRAIN = 1
-REUSE = 2
-from utils import load_w2v_model_from_path, load_data, extract_truth_labels_as_dict, initalise_logging
-
-FAST_TEXT_FLAG = "fast_text"
-TF_IDF_FLAG = "tf-idf"
-LSI_FLAG = "lsi"
-LDA_FLAG = "lda"
-NOVEL_FLAG = "lstm_novel"
-W2V_FLAG = "lstm_w2v"
-GAZETTE_FLAG = "gazette"
-
-SUM_SENTENCES_FILE = './data/newtrain.p'
+import feature_assembly
+import gazette_matcher
+import gazette_model
+import lda_model
+import lsi_model
+import lstm_model
+import tf_idf_model
+import tokenization
+import utils
+from feature_assembly import SparseBatchSequence, wide_feature_blocks
+from gazette_model import load_gazette_index, match_gazette, lexicon_sources
+from instrumentation import timed, RunReport, RUN_REPORT_SUFFIX
+from lda_model import get_lda_topics
+from lsi_model import build_LSI_model
+from lstm_model import lstm_main, lstm_predict, configure_session, PREDICT_BATCH_SIZE, TF_INTRA_OP_THREADS, \
+    TF_INTER_OP_THREADS
+from stage_graph import StageGraph, STAGE_CACHE_DIRECTORY, fingerprint_arrays, save_pickle, load_pickle
+from summary_store import SummaryStore, SUMMARY_STORE_FILE
+from tf_idf_model import tf_idf_vectorizer_big, build_logistic_regression_model, tf_idf_vectorizer_hashed, \
+    export_stacked_logistic_regression
+from toxicity_pipeline import ToxicityPipeline, PIPELINE_CHUNK_SIZE
+from transformer_registry import TransformerRegistry, fingerprint_texts, TF_IDF_CHAR_TRANSFORMER, \
+    TF_IDF_WORD_TRANSFORMER, TF_IDF_LR_TRANSFORMER, TF_IDF_LR_STACKED_TRANSFORMER, LSI_TRANSFORMER, \
+    LDA_TRANSFORMER, LDA_VECTORIZER_TRANSFORMER, KERAS_TOKENIZER_TRANSFORMER
+from utils import COMMENT_TEXT_INDEX, ID_INDEX, BALANCED_DATA_FILE
+from utils import load_w2v_model_from_path, load_data, extract_truth_labels_as_dict, initalise_logging, \
+    tokenize_sentences
+
 FILE_NAME_STRING_DELIMITER = "_"
 FILE_NAME_STRING_FORMATING = "%d_%m_%y_%H_%M_%S"
 KERAS_MODEL_DIRECTORY = 'keras_models/{}'
 TRAIN_HISTORY_DICT_PATH = 'keras_models/{}/trainHistoryDict'
 MODEL_SAVE_PATH = 'keras_models/{}/keras_model.h5'
 
-SPARSE_ARRAY_NAME = "sparse_array.npy"
-W2V_VECTOR_NAME = "w2v_vec.npy"
-NOVEL_VECTOR_NAME = "novel_vec.npy"
-PRE_TRAINED_RESULT = "pre_train.npy"
-NOVEL_TRAINED_RESULT = "novel_train.npy"
-TF_IDF_SMALL = "tf_idf_small.npy"
-TF_IDF_BIG = "tf_idf_small.npy"
-LSI_MODEL = "lsi.npy"
-LDA_MODEL = "lda.npy"
+KERAS_MODEL_SUFFIX = ".h5"
+PREDICTED_RESULTS_NAME = "predicted_results.csv"
+PIPELINE_DIRECTORY = "pipeline/"
+TRANSFORMER_REGISTRY_DIRECTORY = "transformers/"
+
+# sources
+TRAIN_SENTENCES = "train_sentences"
+SUMMARIZED_SENTENCES = "summarized_sentences"
+TRUTH_DICTIONARY = "truth_dictionary"
+W2V_MODEL = "w2v_model"
+
+# training stages
+GAZETTE_STAGE = "gazette"
+W2V_GRU_STAGE = "w2v_gru"
+W2V_FEATURES_STAGE = "w2v_features"
+NOVEL_GRU_STAGE = "novel_gru"
+NOVEL_FEATURES_STAGE = "novel_features"
+TF_IDF_STAGE = "tf_idf"
+TF_IDF_LR_STAGE = "tf_idf_lr"
+LSI_STAGE = "lsi"
+LDA_STAGE = "lda"
+WIDE_STAGE = "wide"
+
+TRAINING_STAGES = [GAZETTE_STAGE, W2V_GRU_STAGE, NOVEL_GRU_STAGE, TF_IDF_STAGE, TF_IDF_LR_STAGE, LSI_STAGE, LDA_STAGE,
+                   WIDE_STAGE]
+
+# independent stages run in their own processes, the GRUs get most of the cores while the cheap stages overlap them
+STAGE_WORKERS = 4
+STAGE_THREADS = {GAZETTE_STAGE: 2, W2V_GRU_STAGE: 4, NOVEL_GRU_STAGE: 4, W2V_FEATURES_STAGE: 2, NOVEL_FEATURES_STAGE: 2,
+                 LDA_STAGE: 2, TF_IDF_LR_STAGE: 2, WIDE_STAGE: 2}
 
 X_TRAIN_DATA_INDEX = 0
 X_TEST_DATA_INDEX = 1
@@ -57,213 +84,280 @@ Y_TEST_DATA_INDEX = 3
 BATCH_SIZE = 100
 
 
-def main(train_data_file, predict_data_file, summarized_sentences, w2v_model, testing, save_file_directory="",
-         train_new=True, train_flag_dict=None, logger=None):
-    assert type(summarized_sentences) == list
-    assert type(summarized_sentences[0]) == str
-    train_df = load_data(train_data_file)
-    assert isinstance(train_df, pd.DataFrame)
-
-    # get truth dictionary
-    truth_dictionary = extract_truth_labels_as_dict(train_df)
-
-    if not testing:
-        truth_dictionary.popitem()
-        truth_dictionary.popitem()
-        truth_dictionary.popitem()
-        truth_dictionary.popitem()
-        truth_dictionary.popitem()
-
-    train_sentences = train_df[COMMENT_TEXT_INDEX]
-    summarized_sentences = summarized_sentences[:len(train_df)]
-
-    # get w2v lstm matrices
-    if train_flag_dict[W2V_FLAG] == TRAIN:
-        np_vector_array, w2v_model_dict = lstm_main(summarized_sentences=summarized_sentences,
-                                                    truth_dictionary=truth_dictionary,
-                                                    w2v_model=w2v_model, testing=testing,
-                                                    use_w2v=True, logger=logger)
-        for model_name in w2v_model_dict:
-            model = w2v_model_dict[model_name]
-            model.save(save_file_directory + model_name + PRE_TRAINED_RESULT)
-        np.save(save_file_directory + W2V_VECTOR_NAME, np_vector_array)
-        del np_vector_array
-        del w2v_model_dict
-
-    # get novel lstm matrices
-    if train_flag_dict[NOVEL_FLAG] == TRAIN:
-        transformed_text, novel_model_dict, tokenizer = lstm_main(
-            summarized_sentences=summarized_sentences,
-            truth_dictionary=truth_dictionary,
-            w2v_model=None, testing=testing,
-            use_w2v=False, logger=logger)
-        for model_name in novel_model_dict:
-            model = novel_model_dict[model_name]
-            model.save(save_file_directory + model_name + NOVEL_TRAINED_RESULT)
-        np.save(save_file_directory + NOVEL_VECTOR_NAME, transformed_text)
-
-    # get tf-idf vectorizer
-    vector_small = tf_idf_vectorizer_small(train_sentences, logger=logger)
-    logger.info("getting tf-idf small vector of resultsd of shape", vector_small.shape)
-    np.save(save_file_directory + TF_IDF_SMALL, vector_small)
-    vector_big, vect_char, vect_word = tf_idf_vectorizer_big(train_sentences, logger=logger)
-    logger.info(vector_big)
-    lr_dict, tfidf_lr_results = build_logistic_regression_model(vector_big, truth_dictionary,
-                                                                logger=logger)
-    np.save(save_file_directory + TF_IDF_BIG, vector_big)
-    logger.info("getting tf-idf log reg results")
-
-    # reshaping needed because only interested in class 1
-    for key in tfidf_lr_results:
-        tfidf_lr_results[key] = np.array(
-            [i[1] for i in tfidf_lr_results[key]]).reshape(
-            (len(tfidf_lr_results[key]), 1))
-
-    # get lsi
-    lsi_model, lsi_topics = build_LSI_model(train_sentences)
-    np.save(save_file_directory + LSI_MODEL, lsi_topics)
-
-    # get lda
-    lda_model, lda_topics = get_lda_topics(train_sentences)
-    np.save(save_file_directory + LDA_MODEL, lda_topics)
-
-    # get gazette matrices
-    if train_flag_dict[GAZETTE_FLAG] == TRAIN:
-        sparse_gazette_matrices = process_bad_words(train_sentences)
-        np.save(save_file_directory + SPARSE_ARRAY_NAME, sparse_gazette_matrices)
-        assert sparse_gazette_matrices.shape == (len(train_sentences), 3933)
-        del sparse_gazette_matrices
-
-    sparse_gazette_matrices = np.load(save_file_directory + SPARSE_ARRAY_NAME)
-    assert sparse_gazette_matrices.shape == (len(train_sentences), 3933)
-    logger.info("done getting sparse matrices of shape %s", sparse_gazette_matrices.shape)
-
-    w2v_model_dict = {}
-    np_vector_array = np.load(save_file_directory + W2V_VECTOR_NAME)
-    for key in truth_dictionary:
-        w2v_model_dict[key] = load_model(save_file_directory + key + PRE_TRAINED_RESULT)
-    w2v_results = lstm_predict(model_dict=w2v_model_dict, predicted_data=np_vector_array,
-                               truth_dictionary=truth_dictionary,
-                               use_w2v=True, logger=logger)
-    logger.info("done getting w2v matrices of shape")
-
-    novel_model_dict = {}
-    for key in truth_dictionary:
-        novel_model_dict[key] = load_model(save_file_directory + key + NOVEL_TRAINED_RESULT)
-    transformed_text = np.load(save_file_directory + NOVEL_VECTOR_NAME)
-    novel_results = lstm_predict(model_dict=novel_model_dict, predicted_data=transformed_text,
-                                 truth_dictionary=truth_dictionary,
-                                 use_w2v=False, logger=logger)
-    logger.info("done getting novel matrices of shape")
-
+def save_keras_output(output, directory):
+    """output is (model dict, *picklable values), the models go to .h5 files next to a pickle of the rest"""
+    model_dict = output[0]
+    for name, model in model_dict.items():
+        model.save(os.path.join(directory, name + KERAS_MODEL_SUFFIX))
+    save_pickle((list(model_dict),) + tuple(output[1:]), directory)
+
+
+def load_keras_output(directory):
+    names, *rest = load_pickle(directory)
+    model_dict = {name: load_model(os.path.join(directory, name + KERAS_MODEL_SUFFIX)) for name in names}
+    return (model_dict,) + tuple(rest)
+
+
+def configure_stage_worker(threads):
+    """
+    sizes the tensorflow session of a keras stage's worker process to its thread budget, the other stages never
+    touch tensorflow so they do not get a session whose threads their forked pools would copy
+    """
+    configure_session(intra_op_threads=threads, inter_op_threads=min(threads, 2))
+
+
+# ------------------------ TRAINING STAGES -----------------------
+
+def gazette_stage(sentences, gazette_sources, threads=None, logger=None):
+    """
+    :param gazette_sources: lexicon_sources the index is built from, so a changed lexicon reruns this stage and the
+     wide models trained on its columns
+    :return: (gazette matrix, the gazette index its columns come from)
+    """
+    gazette_index = load_gazette_index()
+    if gazette_index['sources'] != gazette_sources:
+        raise RuntimeError("lexicon files changed since the stage graph was built")
+    return match_gazette(gazette_index, sentences, n_jobs=threads), gazette_index
+
+
+def w2v_gru_stage(summarized_sentences, truth_dictionary, w2v_model, testing, w2v_indices, multi_task, bucketed,
+                  threads=None, logger=None):
+    """:return: (model dict, training input, w2v vocabulary the ids refer to or None for float input)"""
+    # lstm_main tokenizes in this process (n_jobs=1), a pool forked from it would copy its tensorflow session. In a
+    # worker the pool runs first instead, before the session exists, and fills the token cache lstm_main reads
+    if threads is not None:
+        tokenize_sentences(summarized_sentences, n_jobs=threads)
+        configure_stage_worker(threads)
+    if w2v_indices:
+        np_index_array, model_dict, w2v_vocabulary = lstm_main(summarized_sentences=summarized_sentences,
+                                                               truth_dictionary=truth_dictionary,
+                                                               w2v_model=w2v_model, testing=testing,
+                                                               use_w2v=True, use_w2v_indices=True,
+                                                               multi_task=multi_task, bucketed=bucketed,
+                                                               n_jobs=1, logger=logger)
+        return model_dict, np_index_array, w2v_vocabulary
+    np_vector_array, model_dict = lstm_main(summarized_sentences=summarized_sentences,
+                                            truth_dictionary=truth_dictionary, w2v_model=w2v_model, testing=testing,
+                                            use_w2v=True, multi_task=multi_task, bucketed=bucketed, n_jobs=1,
+                                            logger=logger)
+    return model_dict, np_vector_array, None
+
+
+def novel_gru_stage(summarized_sentences, truth_dictionary, testing, multi_task, bucketed, logger=None):
+    """:return: (model dict, padded training ids, fitted keras tokenizer)"""
+    transformed_text, model_dict, tokenizer = lstm_main(summarized_sentences=summarized_sentences,
+                                                        truth_dictionary=truth_dictionary, w2v_model=None,
+                                                        testing=testing, use_w2v=False, multi_task=multi_task,
+                                                        bucketed=bucketed, logger=logger)
+    return model_dict, transformed_text, tokenizer
+
+
+def gru_features_stage(gru_output, truth_dictionary, use_w2v, bucketed, batch_size, logger=None):
+    model_dict, training_input = gru_output[0], gru_output[1]
+    return lstm_predict(model_dict=model_dict, predicted_data=training_input, truth_dictionary=truth_dictionary,
+                        use_w2v=use_w2v, bucketed=bucketed, batch_size=batch_size, logger=logger)
+
+
+def tf_idf_stage(train_sentences, hashed, logger=None):
+    """:return: (tf-idf matrix, char vectorizer, word vectorizer)"""
+    if hashed:
+        return tf_idf_vectorizer_hashed(train_sentences, logger=logger)
+    return tf_idf_vectorizer_big(train_sentences, logger=logger)
+
+
+def tf_idf_lr_stage(tf_idf_output, truth_dictionary, threads=None, logger=None):
+    """:return: (lr model per label, training class 1 probability per label as a column)"""
+    lr_dict, tfidf_lr_results = build_logistic_regression_model(tf_idf_output[0], truth_dictionary,
+                                                                logger=logger, n_jobs=threads)
+    # only interested in class 1
+    return lr_dict, {key: np.asarray(tfidf_lr_results[key])[:, 1:2] for key in tfidf_lr_results}
+
+
+def lsi_stage(train_sentences, logger=None):
+    """:return: (fitted featurizer, training topics)"""
+    return build_LSI_model(train_sentences)
+
+
+def lda_stage(train_sentences, threads=None, logger=None):
+    """:return: (fitted model, training topics, count vectorizer)"""
+    return get_lda_topics(train_sentences, n_jobs=threads or -1, logger=logger)
+
+
+def wide_stage(gazette_output, w2v_results, novel_results, lsi_output, lda_output, tf_idf_lr_output,
+               truth_dictionary, testing, logger=None):
+    sparse_gazette_matrices = gazette_output[0]
+    lsi_topics, lda_topics, tfidf_lr_results = lsi_output[1], lda_output[1], tf_idf_lr_output[1]
     dictionary_of_wide_model = {}
     for key in truth_dictionary:
         logger.info("training wide model now")
-        for array in (
-                sparse_gazette_matrices, w2v_results[key], novel_results[key], vector_small, lsi_topics, lda_topics,
-                tfidf_lr_results[key]):
-            print(array.shape)
-        dense_vector_small = vector_small.toarray()
-        np_full_array = np.hstack(
-            (sparse_gazette_matrices, w2v_results[key], novel_results[key], lsi_topics, lda_topics,
-             tfidf_lr_results[key]))
-        logger.info("shape of array for wide network is", np_full_array.shape)
-        model = deep_and_wide_network(np_full_array=np_full_array,
+        wide_features = wide_feature_blocks(sparse_gazette_matrices, w2v_results[key], novel_results[key], lsi_topics,
+                                            lda_topics, tfidf_lr_results[key])
+        logger.info("shape of array for wide network is %s", wide_features.shape)
+        model = deep_and_wide_network(wide_features=wide_features,
                                       testing=testing,
                                       truth_dictionary=truth_dictionary, key=key, logger=logger)
         dictionary_of_wide_model[key] = model
-
-    # full prediction step
-    # ------------------------ PREDICTION -----------------------
-    predict_df = load_data(predict_data_file)
-    assert isinstance(predict_df, pd.DataFrame)
-    predict_sentences = [i for i in predict_df[COMMENT_TEXT_INDEX]]
-    predicted_sparse_gazette_matrices = process_bad_words(predict_df[COMMENT_TEXT_INDEX])
-
-    for key in truth_dictionary:
-        w2v_model_dict[key] = load_model(save_file_directory + key + PRE_TRAINED_RESULT)
-    np_vector_array = transform_text_in_df_return_w2v_np_vectors(predict_sentences, w2v_model)
-
-    predict_w2v_results = lstm_predict(model_dict=w2v_model_dict, predicted_data=np_vector_array,
-                                       truth_dictionary=truth_dictionary,
-                                       use_w2v=True, logger=logger)
-    from keras.preprocessing.text import Tokenizer
-
-    tokenizer = Tokenizer(num_words=MAX_VOCAB_SIZE,
-                          filters='!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n',
-                          lower=True,
-                          split=" ",
-                          char_level=False)
-    tokenizer.fit_on_texts(summarized_sentences)
-    predicted_transformed_text = tokenizer.texts_to_sequences(predict_sentences)
-
-    padded_text = []
-    for chunk in chunks(predicted_transformed_text, 10):
-        padded_text.extend(sequence.pad_sequences(chunk, maxlen=MAX_NUM_WORDS_ONE_HOT))
-    padded_text = np.array(padded_text)
-
-    predict_novel_results = lstm_predict(model_dict=novel_model_dict, predicted_data=padded_text,
-                                         truth_dictionary=truth_dictionary,
-                                         use_w2v=True, logger=logger)
-
-    predicted_lda_topics = predict_lda_topics(lda_model, predict_sentences)
-    predicted_lsi_topics = predict_LSI_model(lsi_model, predict_sentences)
-
-    # get tf-idf vectorizer
-    #      vector_small = tf_idf_vectorizer_small(train_sentences, logger=logger)
-    #     logger.info("getting tf-idf small vector of resultsd of shape", vector_small.shape)
-    #    np.save(save_file_directory + TF_IDF_SMALL, vector_small)
-    sparse_matrix_word = vect_word.transform(predict_sentences)
-    sparse_matrix_char = vect_char.transform(predict_sentences)
-    from scipy import sparse
-    sparse_matrix_combined = sparse.hstack([sparse_matrix_word, sparse_matrix_char])
-    predicted_tfidf_lr_results = {}
-    for key in truth_dictionary:
-        predicted_tfidf_lr_results[key] = lr_dict[key].predict_proba(sparse_matrix_combined)
-
-    # reshaping needed because only interested in class 1
-    for key in predicted_tfidf_lr_results:
-        predicted_tfidf_lr_results[key] = np.array(
-            [i[1] for i in predicted_tfidf_lr_results[key]]).reshape(
-            (len(predicted_tfidf_lr_results[key]), 1))
-
-    results_list = []
-    for key in truth_dictionary:
-        logger.info("predicting results now")
-        for array in (predicted_sparse_gazette_matrices, predict_w2v_results[key], predict_novel_results[key],
-             predicted_lda_topics,
-             predicted_lsi_topics, predicted_tfidf_lr_results[key]):
-            print (array.shape)
-        np_full_array = np.hstack(
-            (predicted_sparse_gazette_matrices, predict_w2v_results[key], predict_novel_results[key],
-             predicted_lda_topics,
-             predicted_lsi_topics, predicted_tfidf_lr_results[key]))
-        model = dictionary_of_wide_model[key]
-        results = [key] + [i for i in  model.predict_classes(np_full_array)]
-        results_list.append(results)
-
-    with open(save_file_directory + "predicted_results.csv","w") as csv_file:
-        import csv
-        csv_writer = csv.writer(csv_file)
-        for i in range(len(results_list[0])):
-            row = []
-            for j in range(len(results_list)):
-                row.append(results_list[j][i])
-            csv_writer.writerow(row)
-
-
-def deep_and_wide_network(np_full_array, testing, truth_dictionary, key, logger):
+    return (dictionary_of_wide_model,)
+
+
+def build_stage_graph(train_sentences, summarized_sentences, truth_dictionary, w2v_model, testing,
+                      stage_cache_directory=STAGE_CACHE_DIRECTORY, w2v_indices=True, hashed_tf_idf=False,
+                      multi_task_gru=True, bucketed_gru=False, predict_batch_size=PREDICT_BATCH_SIZE, logger=None):
+    """
+    every fitted part of the deep and wide model as a stage, cached by the data, parameters and code it depends on
+    """
+    graph = StageGraph(stage_cache_directory, logger=logger)
+    graph.add_source(TRAIN_SENTENCES, train_sentences, fingerprint_texts(train_sentences))
+    graph.add_source(SUMMARIZED_SENTENCES, summarized_sentences, fingerprint_texts(summarized_sentences))
+    graph.add_source(TRUTH_DICTIONARY, truth_dictionary, fingerprint_arrays(truth_dictionary))
+    # a model without a fingerprint (not an embedding store) can not be recognised again, its stages always rerun
+    graph.add_source(W2V_MODEL, w2v_model, w2v_model.fingerprint() if hasattr(w2v_model, 'fingerprint')
+                     else "unfingerprinted-{}-{}".format(id(w2v_model), time.time()))
+
+    gru_params = {'testing': testing, 'multi_task': multi_task_gru, 'bucketed': bucketed_gru}
+    graph.add_stage(GAZETTE_STAGE, gazette_stage, [TRAIN_SENTENCES], {'gazette_sources': lexicon_sources()},
+                    modules=[gazette_model, gazette_matcher, tokenization], threaded=True)
+    graph.add_stage(W2V_GRU_STAGE, w2v_gru_stage, [SUMMARIZED_SENTENCES, TRUTH_DICTIONARY, W2V_MODEL],
+                    dict(gru_params, w2v_indices=w2v_indices), modules=[lstm_model, utils],
+                    save=save_keras_output, load=load_keras_output, threaded=True)
+    graph.add_stage(W2V_FEATURES_STAGE, gru_features_stage, [W2V_GRU_STAGE, TRUTH_DICTIONARY],
+                    {'use_w2v': True, 'bucketed': bucketed_gru, 'batch_size': predict_batch_size},
+                    modules=[lstm_model], worker_setup=configure_stage_worker)
+    graph.add_stage(NOVEL_GRU_STAGE, novel_gru_stage, [SUMMARIZED_SENTENCES, TRUTH_DICTIONARY], gru_params,
+                    modules=[lstm_model], save=save_keras_output, load=load_keras_output,
+                    worker_setup=configure_stage_worker)
+    graph.add_stage(NOVEL_FEATURES_STAGE, gru_features_stage, [NOVEL_GRU_STAGE, TRUTH_DICTIONARY],
+                    {'use_w2v': False, 'bucketed': bucketed_gru, 'batch_size': predict_batch_size},
+                    modules=[lstm_model], worker_setup=configure_stage_worker)
+    graph.add_stage(TF_IDF_STAGE, tf_idf_stage, [TRAIN_SENTENCES], {'hashed': hashed_tf_idf}, modules=[tf_idf_model])
+    graph.add_stage(TF_IDF_LR_STAGE, tf_idf_lr_stage, [TF_IDF_STAGE, TRUTH_DICTIONARY], modules=[tf_idf_model],
+                    threaded=True)
+    graph.add_stage(LSI_STAGE, lsi_stage, [TRAIN_SENTENCES], modules=[lsi_model])
+    graph.add_stage(LDA_STAGE, lda_stage, [TRAIN_SENTENCES], modules=[lda_model], threaded=True)
+    # deep_and_wide_network is defined in this module, so its whole source is part of the wide stage's key
+    graph.add_stage(WIDE_STAGE, wide_stage, [GAZETTE_STAGE, W2V_FEATURES_STAGE, NOVEL_FEATURES_STAGE, LSI_STAGE,
+                                             LDA_STAGE, TF_IDF_LR_STAGE, TRUTH_DICTIONARY],
+                    {'testing': testing}, modules=[sys.modules[__name__], feature_assembly],
+                    save=save_keras_output, load=load_keras_output, worker_setup=configure_stage_worker)
+    return graph
+
+
+def save_transformers_to_registry(outputs, registry, train_fingerprint, summarized_fingerprint):
+    """
+    the registry the pipeline reads its transformers from and incremental_update refreshes
+
+    :return: registry name -> fingerprint of every saved transformer
+    :rtype: dict
+    """
+    _, vect_char, vect_word = outputs[TF_IDF_STAGE]
+    lr_dict = outputs[TF_IDF_LR_STAGE][0]
+    registry.save(TF_IDF_CHAR_TRANSFORMER, vect_char, train_fingerprint)
+    registry.save(TF_IDF_WORD_TRANSFORMER, vect_word, train_fingerprint)
+    registry.save(TF_IDF_LR_TRANSFORMER, lr_dict, train_fingerprint)
+    registry.save(TF_IDF_LR_STACKED_TRANSFORMER, export_stacked_logistic_regression(lr_dict), train_fingerprint)
+    registry.save(LSI_TRANSFORMER, outputs[LSI_STAGE][0], train_fingerprint)
+    registry.save(LDA_TRANSFORMER, outputs[LDA_STAGE][0], train_fingerprint)
+    registry.save(LDA_VECTORIZER_TRANSFORMER, outputs[LDA_STAGE][2], train_fingerprint)
+    registry.save(KERAS_TOKENIZER_TRANSFORMER, outputs[NOVEL_GRU_STAGE][2], summarized_fingerprint)
+    return {name: registry.header(name)['fingerprint'] for name in (
+        TF_IDF_CHAR_TRANSFORMER, TF_IDF_WORD_TRANSFORMER, TF_IDF_LR_TRANSFORMER, TF_IDF_LR_STACKED_TRANSFORMER,
+        LSI_TRANSFORMER, LDA_TRANSFORMER, LDA_VECTORIZER_TRANSFORMER, KERAS_TOKENIZER_TRANSFORMER)}
+
+
+def build_toxicity_pipeline(outputs, registry, fingerprints, truth_dictionary, w2v_model, bucketed_gru=False,
+                            predict_batch_size=PREDICT_BATCH_SIZE, logger=None):
+    """
+    :param outputs: graph.run output of TRAINING_STAGES
+    :param fingerprints: from save_transformers_to_registry, the transformers are read back from registry by these
+    """
+    w2v_model_dict, _, w2v_vocabulary = outputs[W2V_GRU_STAGE]
+    novel_model_dict = outputs[NOVEL_GRU_STAGE][0]
+    return ToxicityPipeline(labels=list(truth_dictionary), w2v_model=w2v_model, w2v_model_dict=w2v_model_dict,
+                            w2v_vocabulary=w2v_vocabulary, novel_model_dict=novel_model_dict, registry=registry,
+                            fingerprints=fingerprints, wide_model_dict=outputs[WIDE_STAGE][0],
+                            gazette_index=outputs[GAZETTE_STAGE][1], bucketed=bucketed_gru,
+                            batch_size=predict_batch_size, logger=logger)
+
+
+def main(train_data_file, predict_data_file, summary_store, w2v_model, testing, save_file_directory="",
+         stage_cache_directory=STAGE_CACHE_DIRECTORY, w2v_indices=True, hashed_tf_idf=False, multi_task_gru=True,
+         bucketed_gru=False, predict_batch_size=PREDICT_BATCH_SIZE, max_workers=STAGE_WORKERS,
+         stage_threads=STAGE_THREADS, predict_chunk_size=PIPELINE_CHUNK_SIZE, logger=None):
+    """
+    :param max_workers: stages run at the same time in separate processes, 1 runs every stage in this process
+    :param stage_threads: stage name -> threads its worker may use, stages missing from it get one
+    :param predict_chunk_size: rows of predict_data_file scored at a time
+    """
+    # timings, peak memory and shapes of every step, written next to the experiment directory even if a step fails
+    with RunReport(os.path.basename(save_file_directory.rstrip('/')),
+                   save_file_directory.rstrip('/') + RUN_REPORT_SUFFIX, logger=logger) as report:
+        with timed("load training data", logger=logger) as record:
+            train_df = load_data(train_data_file)
+            record['rows'] = len(train_df)
+        assert isinstance(train_df, pd.DataFrame)
+
+        # get truth dictionary
+        truth_dictionary = extract_truth_labels_as_dict(train_df)
+
+        if not testing:
+            truth_dictionary.popitem()
+            truth_dictionary.popitem()
+            truth_dictionary.popitem()
+            truth_dictionary.popitem()
+            truth_dictionary.popitem()
+
+        train_sentences = list(train_df[COMMENT_TEXT_INDEX])
+        # looked up by comment id and text hash, only comments not summarized before are summarized now
+        with timed("summarize", rows=len(train_sentences), logger=logger):
+            summarized_sentences = summary_store.summarize(train_df[ID_INDEX], train_sentences)
+
+        # only the stages whose data, parameters or code changed since their cached output are recomputed
+        graph = build_stage_graph(train_sentences, summarized_sentences, truth_dictionary, w2v_model, testing,
+                                  stage_cache_directory=stage_cache_directory, w2v_indices=w2v_indices,
+                                  hashed_tf_idf=hashed_tf_idf, multi_task_gru=multi_task_gru,
+                                  bucketed_gru=bucketed_gru, predict_batch_size=predict_batch_size, logger=logger)
+        report.add_graph(graph)
+        with timed("training stages", rows=len(train_sentences), logger=logger):
+            if max_workers == 1:
+                outputs = graph.run(TRAINING_STAGES)
+            else:
+                outputs = graph.run_parallel(TRAINING_STAGES, max_workers=max_workers, stage_threads=stage_threads)
+
+        with timed("save transformers", logger=logger):
+            registry = TransformerRegistry(save_file_directory + TRANSFORMER_REGISTRY_DIRECTORY)
+            fingerprints = save_transformers_to_registry(outputs, registry, fingerprint_texts(train_sentences),
+                                                         fingerprint_texts(summarized_sentences))
+
+        # ------------------------ PREDICTION -----------------------
+        with timed("build pipeline", logger=logger):
+            pipeline = build_toxicity_pipeline(outputs, registry, fingerprints, truth_dictionary, w2v_model,
+                                               bucketed_gru=bucketed_gru, predict_batch_size=predict_batch_size,
+                                               logger=logger)
+        del outputs
+        with timed("save pipeline", logger=logger):
+            pipeline.save(save_file_directory + PIPELINE_DIRECTORY)
+        with timed("predict file", logger=logger) as record:
+            record['rows'] = pipeline.predict_file(predict_data_file, save_file_directory + PREDICTED_RESULTS_NAME,
+                                                   chunk_size=predict_chunk_size)
+
+
+def deep_and_wide_network(wide_features, testing, truth_dictionary, key, logger):
+    """
+    :param wide_features: WideFeatureMatrix, only densified one minibatch at a time
+    """
     # get w2v lstm matrices
     if testing:
         number_of_epochs = 1
     else:
         number_of_epochs = 100
 
-    full_x_train, full_x_test, y_train, y_test = train_test_split(np_full_array, truth_dictionary[key],
-                                                                  test_size=0.05, random_state=42)
+    # split row indices, not the features, so nothing is copied
+    train_index, test_index = train_test_split(np.arange(len(wide_features)), test_size=0.05, random_state=42)
+    truth_labels = truth_dictionary[key]
+    y_test = truth_labels[test_index]
 
     sparse_model = Sequential()
-    sparse_model.add(Dense(128, input_shape=(np_full_array.shape[1],)))
+    sparse_model.add(Dense(128, input_shape=(wide_features.shape[1],)))
     sparse_model.add(Dropout(0.2))
     sparse_model.add(Dense(100))
     sparse_model.add(Dropout(0.2))
@@ -277,71 +371,54 @@ def deep_and_wide_network(np_full_array, testing, truth_dictionary, key, logger)
                          metrics=['accuracy'])
     early_stop_callback = keras.callbacks.EarlyStopping(monitor='val_loss', patience=4, verbose=0, mode='auto')
 
-    sparse_model.fit(full_x_train, y_train, batch_size=BATCH_SIZE, nb_epoch=number_of_epochs,
-                     callbacks=[early_stop_callback, ])
-    sparse_model.evaluate(full_x_test, y_test)
-    validation = sparse_model.predict_classes(full_x_test)
+    train_sequence = SparseBatchSequence(wide_features, truth_labels, batch_size=BATCH_SIZE, indices=train_index,
+                                         shuffle=True)
+    with timed("wide fit " + key, rows=len(train_index), logger=logger):
+        sparse_model.fit_generator(train_sequence, steps_per_epoch=len(train_sequence), epochs=number_of_epochs,
+                                   callbacks=[early_stop_callback, ])
+    test_sequence = SparseBatchSequence(wide_features, truth_labels, batch_size=BATCH_SIZE, indices=test_index)
+    prediction_sequence = SparseBatchSequence(wide_features, batch_size=BATCH_SIZE, indices=test_index)
+    with timed("wide validation predict " + key, rows=len(test_index), logger=logger):
+        sparse_model.evaluate_generator(test_sequence, steps=len(test_sequence))
+        validation = (sparse_model.predict_generator(prediction_sequence,
+                                                     steps=len(prediction_sequence)) > 0.5).astype('int32')
     logger.info('\nConfusion matrix\n %s', confusion_matrix(y_test, validation))
     logger.info('classification report\n %s', classification_report(y_test, validation))
     return sparse_model
 
 
 if __name__ == "__main__":
-    SUM_SENTENCES_FILE = './data/balanced_train.p'
-    summarized_sentence_data = pickle.load(open(SUM_SENTENCES_FILE, "rb"))
+    # before any keras model is built or loaded, every model below runs on this session
+    configure_session(intra_op_threads=TF_INTRA_OP_THREADS, inter_op_threads=TF_INTER_OP_THREADS)
+    summary_store = SummaryStore(SUMMARY_STORE_FILE)
     SAMPLE_DATA_FILE = './data/sample.csv'
     TRAIN_DATA_FILE = './data/small_train.csv'
     PREDICT_DATA_FILE = './data/test_predict.csv'
 
     SAMPLE_W2V_MODEL = './models/GoogleNews-vectors-negative300-SLIM.bin'
-    W2V_MODEL = './models/w2v.840B.300d.txt'
-    sample_model = load_w2v_model_from_path(SAMPLE_W2V_MODEL, binary_input=True)
-
-    # -----------------------------------------------------------------------------------------------------------------
-    # SUPER IMPORTANT FLAG
-
-    train_new = False  # True if training new model, else false
-    EXPT_NAME = "17_03_18_14_20_04"  # ONLY USED OF train_new = False
-    feature_dictionary = {GAZETTE_FLAG: REUSE,
-                          W2V_FLAG: REUSE,
-                          NOVEL_FLAG: REUSE}
-    # -----------------------------------------------------------------------------------------------------------------
-
-    if train_new:
-        EXPT_NAME = time.strftime(FILE_NAME_STRING_FORMATING)
-        SAVE_FILE_PATH = "./expt/" + EXPT_NAME + ""
-        TEST_SAVE_FILE_PATH = SAVE_FILE_PATH + "_TEST/"
-        REAL_SAVE_FILE_PATH = SAVE_FILE_PATH + "_REAL/"
-        os.makedirs(TEST_SAVE_FILE_PATH)
-        os.makedirs(REAL_SAVE_FILE_PATH)
-        test_logger = initalise_logging(TEST_SAVE_FILE_PATH)
-        real_logger = initalise_logging(REAL_SAVE_FILE_PATH)
-
-        test_logger.info("preparing to train new model")
-
-        test_logger.info("doing tests")
-        main(train_data_file=SAMPLE_DATA_FILE, predict_data_file=PREDICT_DATA_FILE,
-             summarized_sentences=summarized_sentence_data,
-             w2v_model=sample_model, testing=True, save_file_directory=TEST_SAVE_FILE_PATH, train_new=True,
-             train_flag_dict=feature_dictionary, logger=test_logger)
-
-        real_logger.info("starting real training")
-        real_model = load_w2v_model_from_path(W2V_MODEL)
-        main(train_data_file=BALANCED_DATA_FILE, predict_data_file=PREDICT_DATA_FILE,
-             summarized_sentences=summarized_sentence_data,
-             w2v_model=real_model, testing=False, save_file_directory=REAL_SAVE_FILE_PATH, train_new=True,
-             train_flag_dict=feature_dictionary, logger=real_logger)
-    else:
-        SAVE_FILE_PATH = "./expt/" + EXPT_NAME + ""
-        REAL_SAVE_FILE_PATH = SAVE_FILE_PATH + "_TEST/"
-        real_logger = initalise_logging(REAL_SAVE_FILE_PATH)
-        real_logger.info("preparing to reuse old model using flags %s", feature_dictionary)
-        try:
-            assert os.path.exists(REAL_SAVE_FILE_PATH)
-        except:
-            raise Exception("Experiment path doesn't exist")
-        real_logger.info("doing tests")
-        main(train_data_file=SAMPLE_DATA_FILE, predict_data_file=PREDICT_DATA_FILE,
-             summarized_sentences=summarized_sentence_data,
-             w2v_model=sample_model, testing=False, save_file_directory=REAL_SAVE_FILE_PATH, train_new=False,
-             train_flag_dict=feature_dictionary, logger=real_logger)
+    SAMPLE_W2V_STORE = './models/GoogleNews-vectors-negative300-SLIM.store/'
+    W2V_MODEL_FILE = './models/w2v.840B.300d.txt'
+    W2V_STORE = './models/w2v.840B.300d.store/'
+    sample_model = load_w2v_model_from_path(SAMPLE_W2V_MODEL, binary_input=True, store_path=SAMPLE_W2V_STORE)
+
+    # every run gets its own directory for logs and results, stage outputs are shared through the stage cache so a
+    # rerun only recomputes what changed
+    EXPT_NAME = time.strftime(FILE_NAME_STRING_FORMATING)
+    SAVE_FILE_PATH = "./expt/" + EXPT_NAME + ""
+    TEST_SAVE_FILE_PATH = SAVE_FILE_PATH + "_TEST/"
+    REAL_SAVE_FILE_PATH = SAVE_FILE_PATH + "_REAL/"
+    os.makedirs(TEST_SAVE_FILE_PATH)
+    os.makedirs(REAL_SAVE_FILE_PATH)
+    test_logger = initalise_logging(TEST_SAVE_FILE_PATH)
+    real_logger = initalise_logging(REAL_SAVE_FILE_PATH)
+
+    test_logger.info("doing tests")
+    main(train_data_file=SAMPLE_DATA_FILE, predict_data_file=PREDICT_DATA_FILE,
+         summary_store=summary_store,
+         w2v_model=sample_model, testing=True, save_file_directory=TEST_SAVE_FILE_PATH, logger=test_logger)
+
+    real_logger.info("starting real training")
+    real_model = load_w2v_model_from_path(W2V_MODEL_FILE, store_path=W2V_STORE)
+    main(train_data_file=BALANCED_DATA_FILE, predict_data_file=PREDICT_DATA_FILE,
+         summary_store=summary_store,
+         w2v_model=real_model, testing=False, save_file_directory=REAL_SAVE_FILE_PATH, logger=real_logger)
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+VECTORS_FILE_NAME = 'vectors.npy'
+VOCAB_FILE_NAME = 'vocab.p'
+STORE_DTYPE = 'float32'
+
+
+class MemmapKeyedVectors(object):
+    """
+    Read-only stand-in for gensim's KeyedVectors backed by a memory-mapped matrix.
+
+    Supports the subset of the KeyedVectors api used in this repo (`word in model.vocab`, `model[word]`,
+    `vector_size`). The matrix is opened with mmap_mode='r', so every process opening the same store shares the
+    same pages through the OS page cache instead of holding its own copy.
+    """
+
+    def __init__(self, store_directory):
+        self.store_directory = store_directory
+        self._vectors = None
+        self._vocab = None
+
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            self._vectors = np.load(os.path.join(self.store_directory, VECTORS_FILE_NAME), mmap_mode='r')
+        return self._vectors
+
+    @property
+    def vocab(self):
+        if self._vocab is None:
+            with open(os.path.join(self.store_directory, VOCAB_FILE_NAME), 'rb') as f:
+                self._vocab = pickle.load(f)
+        return self._vocab
+
+    @property
+    def vector_size(self):
+        return self.vectors.shape[1]
+
+    def fingerprint(self):
+        """identifies the store by location, size and modification time, without reading the vectors"""
+        stats = [os.stat(os.path.join(self.store_directory, name)) for name in (VECTORS_FILE_NAME, VOCAB_FILE_NAME)]
+        return hashlib.sha1(repr([os.path.abspath(self.store_directory)] +
+                                 [(stat.st_size, stat.st_mtime) for stat in stats]).encode('utf-8')).hexdigest()
+
+    def __contains__(self, word):
+        return word in self.vocab
+
+    def __getitem__(self, word):
+        return self.vectors[self.vocab[word]]
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def __getstate__(self):
+        # only ship the location to worker processes, they map the same pages themselves
+        return {'store_directory': self.store_directory}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_directory'])
+
+
+def is_embedding_store(path):
+    return os.path.isfile(os.path.join(path, VECTORS_FILE_NAME)) and os.path.isfile(
+        os.path.join(path, VOCAB_FILE_NAME))
+
+
+def compile_w2v_model_to_store(model_path, store_directory, binary_input=False):
+    """
+    one-time conversion of a w2v model file into a memory-mapped embedding store
+
+    :param model_path: path to w2v model
+    :type model_path: string
+    :param store_directory: directory to write the vector matrix and word index to
+    :type store_directory: string
+    :param binary_input: True : binary input, False : text input
+    :type binary_input: boolean
+    :return: opened store
+    :rtype: MemmapKeyedVectors
+    """
+    os.makedirs(store_directory, exist_ok=True)
+    vectors_path = os.path.join(store_directory, VECTORS_FILE_NAME)
+    if binary_input:
+        from gensim.models import KeyedVectors
+        w2v_model = KeyedVectors.load_word2vec_format(model_path, binary=True)
+        vocab = {word: w2v_model.vocab[word].index for word in w2v_model.vocab}
+        vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=STORE_DTYPE,
+                                            shape=w2v_model.vectors.shape)
+        vectors[:] = w2v_model.vectors
+    else:
+        with open(model_path, encoding='utf-8', errors='replace') as f:
+            number_of_words, vector_size = (int(i) for i in f.readline().split())
+            vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=STORE_DTYPE,
+                                                shape=(number_of_words, vector_size))
+            vocab = {}
+            for row, line in enumerate(f):
+                # words may contain spaces, the vector is always the last vector_size fields
+                parts = line.rstrip('\n').rstrip(' ').rsplit(' ', vector_size)
+                word = parts[0]
+                vectors[row] = np.array(parts[1:], dtype=STORE_DTYPE)
+                if word not in vocab:  # keep the first occurrence, same as gensim
+                    vocab[word] = row
+    vectors.flush()
+    del vectors
+    with open(os.path.join(store_directory, VOCAB_FILE_NAME), 'wb') as f:
+        pickle.dump(vocab, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return MemmapKeyedVectors(store_directory)
+
+
+def load_embedding_store(store_directory):
+    """
+    :param store_directory: directory written by compile_w2v_model_to_store
+    :type store_directory: string
+    :return: lazily opened store, nothing is read until the first lookup
+    :rtype: MemmapKeyedVectors
+    """
+    if not is_embedding_store(store_directory):
+        raise IOError("no embedding store found at {}".format(store_directory))
+    return MemmapKeyedVectors(store_directory)
@@ -0,0 +1,94 @@
+import keras
+import numpy as np
+from scipy import sparse
+
+WIDE_FEATURE_DTYPE = 'float32'
+WIDE_BATCH_SIZE = 100
+
+
+class WideFeatureMatrix(object):
+    """
+    Column-wise concatenation of the wide model's feature blocks that is never materialised as one dense array.
+
+    Sparse blocks (e.g. the gazette matrix) are joined with scipy.sparse.hstack and stay sparse. Dense blocks (GRU
+    features, topics, LR probabilities) are kept as they are, since they already exist in memory. Only the rows of
+    one minibatch at a time are turned into a dense array, so peak memory is about batch size x width on top of the
+    blocks themselves.
+    """
+
+    def __init__(self, blocks):
+        """:param blocks: 2d ndarrays and scipy sparse matrices with the same number of rows, in column order"""
+        number_of_rows = set(block.shape[0] for block in blocks)
+        if len(number_of_rows) != 1:
+            raise ValueError("feature blocks have different numbers of rows {}".format(
+                [block.shape for block in blocks]))
+        # consecutive sparse blocks are merged, the column order of the blocks is kept
+        self.blocks = []
+        sparse_run = []
+        for block in blocks:
+            if sparse.issparse(block):
+                sparse_run.append(block)
+                continue
+            if sparse_run:
+                self.blocks.append(sparse.hstack(sparse_run, format='csr', dtype=WIDE_FEATURE_DTYPE))
+                sparse_run = []
+            self.blocks.append(np.asarray(block))
+        if sparse_run:
+            self.blocks.append(sparse.hstack(sparse_run, format='csr', dtype=WIDE_FEATURE_DTYPE))
+        self.shape = (number_of_rows.pop(), sum(block.shape[1] for block in self.blocks))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def rows(self, rows):
+        """:return: dense float32 array of the given rows, every column block in order"""
+        batch = np.empty((len(rows), self.shape[1]), dtype=WIDE_FEATURE_DTYPE)
+        column = 0
+        for block in self.blocks:
+            width = block.shape[1]
+            batch[:, column:column + width] = block[rows].toarray() if sparse.issparse(block) else block[rows]
+            column += width
+        return batch
+
+
+class SparseBatchSequence(keras.utils.Sequence):
+    """
+    Feeds a WideFeatureMatrix to keras one dense minibatch at a time.
+
+    indices restricts the feeder to a subset of rows (e.g. a train/test split) without copying the features.
+    """
+
+    def __init__(self, features, y=None, batch_size=WIDE_BATCH_SIZE, indices=None, shuffle=False, seed=42):
+        self.features = features
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+        self.indices = np.arange(len(features)) if indices is None else np.array(indices)
+        self.order = np.array(self.indices)
+        if shuffle:
+            self.random_state.shuffle(self.order)
+
+    def __len__(self):
+        return int(np.ceil(len(self.order) / float(self.batch_size)))
+
+    def batch_rows(self, index):
+        return self.order[index * self.batch_size:(index + 1) * self.batch_size]
+
+    def __getitem__(self, index):
+        rows = self.batch_rows(index)
+        x = self.features.rows(rows)
+        if self.y is None:
+            return x
+        return x, self.y[rows]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.random_state.shuffle(self.order)
+
+
+def wide_feature_blocks(sparse_gazette_matrices, gru_w2v_features, gru_novel_features, lsi_topics, lda_topics,
+                        tfidf_lr_probabilities):
+    """the wide model's input for one label, training and prediction share this so the column order can not drift"""
+    return WideFeatureMatrix([sparse_gazette_matrices, gru_w2v_features, gru_novel_features, lsi_topics, lda_topics,
+                              tfidf_lr_probabilities])
@@ -0,0 +1,71 @@
+from collections import deque
+
+import numpy as np
+from scipy import sparse
+
+
+class GazetteAutomaton(object):
+    """
+    Aho-Corasick automaton over token sequences.
+
+    Every gazette entry is a tuple of tokens mapped to a column. Matching walks a tokenized document once and
+    reports every entry that occurs in it, so multi-word entries ("blue waffle") are found in the same pass as
+    single tokens.
+    """
+
+    def __init__(self, number_of_columns):
+        self.number_of_columns = number_of_columns
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    def add(self, tokens, column):
+        state = 0
+        for token in tokens:
+            if token not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][token] = len(self.goto) - 1
+            state = self.goto[state][token]
+        self.output[state].append(column)
+
+    def compile(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and token not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(token, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+        return self
+
+    def match(self, tokens):
+        goto, fail, output = self.goto, self.fail, self.output
+        hits = set()
+        state = 0
+        for token in tokens:
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            if output[state]:
+                hits.update(output[state])
+        return hits
+
+    def transform(self, tokenized_documents):
+        """
+        :param tokenized_documents: list of token lists
+        :return: binary document x column matrix
+        :rtype: scipy.sparse.csr_matrix of uint8
+        """
+        indices = []
+        indptr = [0]
+        for document in tokenized_documents:
+            indices.extend(sorted(self.match(document)))
+            indptr.append(len(indices))
+        return sparse.csr_matrix((np.ones(len(indices), dtype=np.uint8), np.array(indices, dtype=np.int32),
+                                  np.array(indptr, dtype=np.int32)),
+                                 shape=(len(indptr) - 1, self.number_of_columns))
@@ -1,60 +1,101 @@
-import itertools
+import os
+import pickle
+import unicodedata
 
-import numpy as np
-import pandas as pd
 from nltk.tokenize import TweetTokenizer
-from sklearn.preprocessing import LabelEncoder
 
+from gazette_matcher import GazetteAutomaton
+from tokenization import tokenize_corpus, TWEET_TOKENIZER, TOKEN_CACHE_FILE
 from tf_idf_model import build_logistic_regression_model
-from utils import load_data, dataframe_to_list, COMMENT_TEXT_INDEX
+from utils import load_data, extract_truth_labels_as_dict, COMMENT_TEXT_INDEX, hash_file, DATA_CACHE_DIRECTORY
 
 UNPROCESSED_BAD_WORDS_DATA = './data/bad_words'
 ARABIC_PERSIAN_BAD_WORDS = './data/arabic_persian'
 COMBI = './data/combined'
 SAMPLE_DATA_FILE = './data/sample.csv'
 DATA_FILE = './data/train.csv'
+LEXICON_FILES = [UNPROCESSED_BAD_WORDS_DATA, ARABIC_PERSIAN_BAD_WORDS, COMBI]
+GAZETTE_INDEX_FILE = DATA_CACHE_DIRECTORY + 'gazette_index.p'
+GAZETTE_INDEX_VERSION = 1
 
 
-def process_bad_words(sentences):
-    bad_words = bad_word_processor(UNPROCESSED_BAD_WORDS_DATA)
-    sparse_gazette_matrixes = filt(bad_words, sentences)
-    return sparse_gazette_matrixes
+def process_bad_words(sentences, index_file=GAZETTE_INDEX_FILE, rebuild_if_stale=True):
+    gazette_index = load_gazette_index(index_file, rebuild_if_stale=rebuild_if_stale)
+    return match_gazette(gazette_index, sentences)
 
 
-def bad_word_processor(data):
-    bw_df = pd.read_csv(data, sep='delimiter', header=None)
-    bw_lst_no_dup = dataframe_to_list(bw_df.drop_duplicates().values)
-    bw_single_lst = list(itertools.chain.from_iterable(bw_lst_no_dup))
-    bw_common_char = [characters.replace("", '') for characters in bw_single_lst]
-    bw_lowercase = [x.lower() for x in bw_common_char]
-    return bw_lowercase
+def match_gazette(gazette_index, sentences, cache_file=TOKEN_CACHE_FILE, n_jobs=None):
+    """
+    :param gazette_index: loaded once with load_gazette_index, for callers matching batch after batch
+    :param cache_file: token cache, None for one-off text that is not worth caching
+    :param n_jobs: tokenizer processes, None for one per core
+    :return: binary sentence x gazette column matrix
+    :rtype: scipy.sparse.csr_matrix
+    """
+    tokenized_data = tokenize_corpus([normalise_text(sentence) for sentence in sentences], TWEET_TOKENIZER,
+                                     n_jobs=n_jobs, cache_file=cache_file)
+    return gazette_index['automaton'].transform(tokenized_data)
 
 
-def filt(keep, data):
-    df = data.str.lower().tolist()
-    df_data = [w.replace("", '') for w in df]
+def normalise_text(text):
+    # NFKC folds full-width/compatibility forms and presentation forms (common in the arabic/persian lists)
+    return unicodedata.normalize('NFKC', text).lower()
 
+
+def lexicon_sources(lexicon_files=LEXICON_FILES):
+    """:return: lexicon file -> content hash, what an index was built from"""
+    return {lexicon_file: hash_file(lexicon_file) for lexicon_file in lexicon_files}
+
+
+def build_gazette_index(lexicon_files=LEXICON_FILES, index_file=GAZETTE_INDEX_FILE):
+    """
+    merge every lexicon file into one sorted, de-duplicated column mapping and persist it with its compiled automaton
+
+    :return: dictionary with the column words, the automaton and the source file hashes it was built from
+    :rtype: dict
+    """
+    keys = set()
+    for lexicon_file in lexicon_files:
+        with open(lexicon_file, encoding='utf-8') as f:
+            for line in f:
+                # some entries are csv-quoted, e.g. "5h1t"
+                key = ' '.join(normalise_text(line).strip().strip('"').split())
+                if key:
+                    keys.add(key)
+    columns = sorted(keys)
     tknzr = TweetTokenizer()
-    # list comprehension style
-    tokenized_data = [tknzr.tokenize(sentence) for sentence in df_data]
-    encoder = LabelEncoder()
-    transformed_keep = encoder.fit_transform(keep)
-    keep_dict = dict(zip(keep, transformed_keep))
-    sparse_gazette_matrixes = []
-    for document in tokenized_data:
-        sparse_gazette_array = np.zeros(len(keep))  # create array for document
-        for word in document:
-            if word in keep_dict:
-                sparse_gazette_array[keep_dict[word]] = 1
-        sparse_gazette_matrixes.append(sparse_gazette_array)
-    return np.array(sparse_gazette_matrixes)
+    automaton = GazetteAutomaton(number_of_columns=len(columns))
+    for column, key in enumerate(columns):
+        tokens = tknzr.tokenize(key) if ' ' in key else [key]
+        if tokens:
+            automaton.add(tokens, column)
+    gazette_index = {'version': GAZETTE_INDEX_VERSION,
+                     'sources': lexicon_sources(lexicon_files),
+                     'columns': columns,
+                     'automaton': automaton.compile()}
+    os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+    with open(index_file, 'wb') as f:
+        pickle.dump(gazette_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return gazette_index
+
+
+def load_gazette_index(index_file=GAZETTE_INDEX_FILE, lexicon_files=LEXICON_FILES, rebuild_if_stale=True):
+    """
+    :param rebuild_if_stale: rebuild when a lexicon file changed since the index was built. Pass False for an index
+     saved with a trained model, so prediction keeps the exact columns the model was trained on
+    """
+    if os.path.exists(index_file):
+        with open(index_file, 'rb') as f:
+            gazette_index = pickle.load(f)
+        if not rebuild_if_stale:
+            return gazette_index
+        if gazette_index['version'] == GAZETTE_INDEX_VERSION and \
+                gazette_index['sources'] == lexicon_sources(lexicon_files):
+            return gazette_index
+    return build_gazette_index(lexicon_files, index_file)
 
 
 if __name__ == "__main__":
     df = load_data(DATA_FILE)
-    sentences = df[COMMENT_TEXT_INDEX]
-    process_bad_words(sentences)
-
-    bad_words = bad_word_processor(UNPROCESSED_BAD_WORDS_DATA)
-    sparse_gazette_matrixes = filt(bad_words, sentences)
-    lr = build_logistic_regression_model(sparse_gazette_matrixes, df)
+    gazette_matrix = match_gazette(load_gazette_index(), df[COMMENT_TEXT_INDEX])
+    lr = build_logistic_regression_model(gazette_matrix, extract_truth_labels_as_dict(df), choose_to_log_data=False)
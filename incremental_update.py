@@ -0,0 +1,57 @@
+from lsi_model import update_LSI_model
+from tf_idf_model import update_tf_idf_vectorizer, update_logistic_regression_model, transform_tf_idf_big, \
+    export_stacked_logistic_regression
+from toxicity_pipeline import pipeline_registry, update_pipeline_fingerprints
+from transformer_registry import fingerprint_texts, combine_fingerprints, TF_IDF_CHAR_TRANSFORMER, \
+    TF_IDF_WORD_TRANSFORMER, TF_IDF_LR_TRANSFORMER, TF_IDF_LR_STACKED_TRANSFORMER, LSI_TRANSFORMER
+from utils import load_data, extract_truth_labels_as_dict, initalise_logging, COMMENT_TEXT_INDEX
+
+
+def refresh_models(pipeline_directory, new_data_file, logger):
+    """
+    nightly refresh: fold a file of newly labelled comments into the LSI, TF-IDF and logistic regression models a
+    saved pipeline predicts with, in time proportional to the new file rather than the full history
+
+    The refreshed models are saved to the pipeline's transformer registry under chained fingerprints and the
+    pipeline is pointed at them last, so a refresh that fails halfway is refused when the pipeline is loaded rather
+    than mixed in. A running scoring server picks the refresh up when it is restarted.
+
+    :param pipeline_directory: pipeline directory of a trained experiment
+    :type pipeline_directory: str
+    :param new_data_file: csv with the same columns as the train file
+    :type new_data_file: str
+    """
+    registry, fingerprints = pipeline_registry(pipeline_directory)
+    new_df = load_data(new_data_file)
+    new_sentences = new_df[COMMENT_TEXT_INDEX]
+    truth_dictionary = extract_truth_labels_as_dict(new_df)
+    batch_fingerprint = fingerprint_texts(new_sentences)
+    logger.info("refreshing %s with %s new comments", pipeline_directory, len(new_df))
+
+    # the entries the pipeline currently uses, a registry that moved on without it is refused
+    lsi_featurizer = registry.load(LSI_TRANSFORMER, fingerprints[LSI_TRANSFORMER])
+    update_LSI_model(lsi_featurizer, new_sentences)
+
+    vect_char = update_tf_idf_vectorizer(registry.load(TF_IDF_CHAR_TRANSFORMER, fingerprints[TF_IDF_CHAR_TRANSFORMER]),
+                                         new_sentences)
+    vect_word = update_tf_idf_vectorizer(registry.load(TF_IDF_WORD_TRANSFORMER, fingerprints[TF_IDF_WORD_TRANSFORMER]),
+                                         new_sentences)
+    lr_dict = registry.load(TF_IDF_LR_TRANSFORMER, fingerprints[TF_IDF_LR_TRANSFORMER])
+    update_logistic_regression_model(lr_dict, transform_tf_idf_big(new_sentences, vect_char, vect_word),
+                                     truth_dictionary, logger=logger)
+
+    for name, transformer in ((LSI_TRANSFORMER, lsi_featurizer), (TF_IDF_CHAR_TRANSFORMER, vect_char),
+                              (TF_IDF_WORD_TRANSFORMER, vect_word), (TF_IDF_LR_TRANSFORMER, lr_dict),
+                              (TF_IDF_LR_STACKED_TRANSFORMER, export_stacked_logistic_regression(lr_dict))):
+        fingerprints[name] = combine_fingerprints(fingerprints[name], batch_fingerprint)
+        registry.save(name, transformer, fingerprints[name])
+    update_pipeline_fingerprints(pipeline_directory, fingerprints)
+    logger.info("done refreshing %s", pipeline_directory)
+
+
+if __name__ == "__main__":
+    EXPT_NAME = "17_03_18_14_20_04"
+    PIPELINE_DIRECTORY = "./expt/" + EXPT_NAME + "_REAL/pipeline/"
+    NEW_DATA_FILE = './data/new_labelled_comments.csv'
+    logger = initalise_logging('./data/Log_files/')
+    refresh_models(PIPELINE_DIRECTORY, NEW_DATA_FILE, logger)
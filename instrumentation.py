@@ -0,0 +1,170 @@
+import functools
+import json
+import resource
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from scipy import sparse
+
+RUN_REPORT_SUFFIX = "_run_report.json"
+MAX_DESCRIBED_ITEMS = 20
+
+# lists finished timer records are added to, innermost last. Without one (e.g. in the scoring server) timers only log
+_collectors = []
+_open_timers = []
+
+
+def peak_rss_mb():
+    """peak resident set size of this process so far, ru_maxrss is in kilobytes on linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def children_cpu_seconds():
+    """cpu time of finished child processes (e.g. the LR and tokenizer pools) that have been waited for"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def describe(value):
+    """:return: json serialisable shapes and dtypes of an output, without its contents"""
+    if sparse.issparse(value):
+        return {'type': 'sparse', 'format': value.format, 'shape': list(value.shape), 'dtype': str(value.dtype),
+                'nnz': int(value.nnz)}
+    if isinstance(value, np.ndarray):
+        return {'type': 'ndarray', 'shape': list(value.shape), 'dtype': str(value.dtype)}
+    if isinstance(value, dict):
+        return {'type': 'dict', 'length': len(value),
+                'items': {str(key): describe(value[key]) for key in list(value)[:MAX_DESCRIBED_ITEMS]}}
+    if isinstance(value, tuple):
+        return {'type': 'tuple', 'items': [describe(item) for item in value[:MAX_DESCRIBED_ITEMS]]}
+    if isinstance(value, list):
+        return {'type': 'list', 'length': len(value)}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {'type': type(value).__name__}
+    description = {'type': type(value).__module__ + '.' + type(value).__name__}
+    if isinstance(getattr(value, 'shape', None), tuple):  # e.g. WideFeatureMatrix
+        description['shape'] = list(value.shape)
+    return description
+
+
+@contextmanager
+def timed(name, rows=None, logger=None):
+    """
+    time a block: wall time, cpu time of this process and of its waited-for children, peak rss and rows/sec
+
+    The yielded record can be extended inside the block, e.g. record['output'] = describe(result).
+
+    :param rows: number of rows the block processes, for rows/sec. Can also be set as record['rows'] inside the block
+    """
+    record = {'name': name, 'rows': rows, 'parent': _open_timers[-1]['name'] if _open_timers else None,
+              'started': time.strftime("%Y-%m-%d %H:%M:%S")}
+    _open_timers.append(record)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    children_start = children_cpu_seconds()
+    rss_start = peak_rss_mb()
+    try:
+        yield record
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        _open_timers.pop()
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        record['children_cpu_seconds'] = children_cpu_seconds() - children_start
+        record['peak_rss_mb'] = peak_rss_mb()
+        # ru_maxrss only ever grows, so this is how far the block pushed the process peak, not its own footprint
+        record['peak_rss_growth_mb'] = record['peak_rss_mb'] - rss_start
+        if record['rows']:
+            record['rows_per_second'] = record['rows'] / max(record['wall_seconds'], 1e-9)
+        if _collectors:
+            _collectors[-1].append(record)
+        if logger:
+            logger.info("%s: %.2fs wall, %.2fs cpu, peak rss %.0f MB%s", name, record['wall_seconds'],
+                        record['cpu_seconds'], record['peak_rss_mb'],
+                        ", %.0f rows/sec" % record['rows_per_second'] if record['rows'] else "")
+
+
+def instrumented(name=None, rows_argument=0):
+    """
+    decorator timing every call, rows are taken as the length of the positional argument at rows_argument
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            rows = None
+            if rows_argument is not None and len(args) > rows_argument:
+                data = args[rows_argument]
+                rows = data.shape[0] if hasattr(data, 'shape') else len(data) if hasattr(data, '__len__') else None
+            with timed(name or function.__name__, rows=rows, logger=kwargs.get('logger')) as record:
+                result = function(*args, **kwargs)
+                record['output'] = describe(result)
+            return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect_records():
+    """:return: list of the records of every timer finishing inside the block, outer collectors do not get them"""
+    records = []
+    _collectors.append(records)
+    try:
+        yield records
+    finally:
+        _collectors.remove(records)
+
+
+class RunReport(object):
+    """
+    Machine readable summary of one run, written as json when the with block is left, also if it raised.
+
+    Holds the records of the timers inside the block plus those a StageGraph saved with every stage, which covers
+    stages run in worker processes, and tells which stages were only loaded from the cache.
+    """
+
+    def __init__(self, name, report_file, logger=None):
+        self.name = name
+        self.report_file = report_file
+        self.logger = logger
+        self.started = None
+        self.timers = []
+        self.graphs = []
+
+    def add_graph(self, graph):
+        """the stages of graph with a cached output are added to the report when it is written"""
+        self.graphs.append(graph)
+
+    def stages(self):
+        stages = []
+        for graph in self.graphs:
+            for name in graph.stages:
+                header = graph.stage_header(name)
+                if header is None:
+                    continue
+                stages.append({'name': name, 'key': graph.key(name), 'cached': name not in graph.computed,
+                               'seconds': header.get('seconds'), 'timers': header.get('timers', [])})
+        return stages
+
+    def to_dict(self):
+        return {'run': self.name, 'started': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+                'wall_seconds': time.time() - self.started, 'peak_rss_mb': peak_rss_mb(), 'timers': self.timers,
+                'stages': self.stages()}
+
+    def write(self):
+        with open(self.report_file, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        if self.logger:
+            self.logger.info("run report written to %s", self.report_file)
+
+    def __enter__(self):
+        self.started = time.time()
+        _collectors.append(self.timers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _collectors.remove(self.timers)
+        self.write()
+        return False
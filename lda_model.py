@@ -1,32 +1,44 @@
-import lda.datasets
-import re
-
+import numpy as np
+from sklearn.decomposition import LatentDirichletAllocation
 from sklearn.feature_extraction.text import CountVectorizer
-from utils import initalise_logging,load_data, COMMENT_TEXT_INDEX,extract_truth_labels_as_dict
-from tf_idf_model import build_logistic_regression_model
+from instrumentation import instrumented
+from utils import initalise_logging,load_data, COMMENT_TEXT_INDEX,extract_truth_labels_as_dict, chunks
+from tf_idf_model import build_logistic_regression_model, search_and_replace_numerals_with_space
+
+LDA_NUM_TOPICS = 2000
+LDA_NUM_PASSES = 5
+LDA_BATCH_SIZE = 4096
+LDA_FOLD_IN_CHUNK_SIZE = 20000
 
 
-def get_lda_topics(sentences):
-    search_and_replace_numerals_with_space = lambda x: re.sub(r'(\d[\d\.])+', '', x.lower())
+@instrumented("lda fit")
+def get_lda_topics(sentences, n_jobs=-1, logger=None):
+    """
+    online (minibatch variational) LDA, the E-step of every minibatch is spread over n_jobs cores
+    :return: fitted model, topic distribution of every training sentence, fitted vocabulary
+    :rtype: LatentDirichletAllocation, np.ndarray of shape (N, LDA_NUM_TOPICS), CountVectorizer
+    """
     vectorizer = CountVectorizer(preprocessor=search_and_replace_numerals_with_space, stop_words='english', min_df=20)
-    sentences = sentences.tolist()
-    vectorizer.fit(sentences)
-    logger
-    logger.info("feature_words %s", vectorizer.get_feature_names())
-    tf_idf_sparse_matrix = vectorizer.transform(sentences)
-    model = lda.LDA(n_topics=2000, n_iter=5, random_state=1)
-    topics = model.fit_transform(tf_idf_sparse_matrix)
-    return model, topics
+    sentences = list(sentences)
+    term_matrix = vectorizer.fit_transform(sentences)
+    if logger:
+        logger.info("lda vocabulary size %s, term matrix of shape %s", len(vectorizer.vocabulary_),
+                    term_matrix.shape)
+    model = LatentDirichletAllocation(n_components=LDA_NUM_TOPICS, learning_method='online',
+                                      batch_size=LDA_BATCH_SIZE, max_iter=LDA_NUM_PASSES, n_jobs=n_jobs,
+                                      random_state=1)
+    model.fit(term_matrix)
+    # the training documents are already vectorised, predict_lda_topics is for new text
+    topics = model.transform(term_matrix).astype('float32')
+    return model, topics, vectorizer
 
 
-def predict_lda_topics(model, sentences):
-    search_and_replace_numerals_with_space = lambda x: re.sub(r'(\d[\d\.])+', '', x.lower())
-    vectorizer = CountVectorizer(preprocessor=search_and_replace_numerals_with_space, stop_words='english', min_df=20)
-    vectorizer.fit(sentences)
-    logger.info("feature_words %s", vectorizer.get_feature_names())
-    tf_idf_sparse_matrix = vectorizer.transform(sentences)
-    topics = model.transform(tf_idf_sparse_matrix)
-    return topics
+def predict_lda_topics(model, sentences, vectorizer, chunk_size=LDA_FOLD_IN_CHUNK_SIZE):
+    """fold new documents into the fitted topics, one vectorised batch at a time, without refitting anything"""
+    # reuse the training vectorizer so the columns line up with the fitted topics
+    sentences = list(sentences)
+    topics = [model.transform(vectorizer.transform(chunk)) for chunk in chunks(sentences, chunk_size)]
+    return np.vstack(topics).astype('float32')
 
 
 if __name__ == "__main__":
@@ -36,6 +48,6 @@ if __name__ == "__main__":
     train_df = load_data(DATA_FILE)
     truth_dictionary = extract_truth_labels_as_dict(train_df)
     train_sentences = train_df[COMMENT_TEXT_INDEX]
-    model, topics = get_lda_topics(train_sentences)
-    predict = predict_lda_topics(model, train_sentences)
+    model, topics, vectorizer = get_lda_topics(train_sentences, logger=logger)
+    predict = predict_lda_topics(model, train_sentences, vectorizer)
     lr = build_logistic_regression_model(predict, truth_dictionary, logger=logger)
\ No newline at end of file
@@ -0,0 +1,88 @@
+import asyncio
+import csv
+import json
+import random
+import time
+
+from scoring_server import SCORING_HOST, SCORING_PORT, percentile
+from utils import COMMENT_TEXT_INDEX
+
+LOAD_CONCURRENCY = 32
+LOAD_REQUESTS = 2000
+LOAD_COMMENTS_PER_REQUEST = 1
+LOAD_SAMPLE_SIZE = 5000
+
+
+def load_comments(data_file, sample_size=LOAD_SAMPLE_SIZE):
+    with open(data_file, encoding='utf-8', newline='') as f:
+        comments = []
+        for row in csv.DictReader(f):
+            comments.append(row[COMMENT_TEXT_INDEX])
+            if len(comments) >= sample_size:
+                break
+    return comments
+
+
+async def http_request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                 '\r\n'.format(method, path, len(body)).encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads((await reader.readexactly(length)).decode('utf-8'))
+
+
+async def client(host, port, comments, requests, comments_per_request, latencies, failures):
+    """one keep-alive connection sending requests back to back"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(requests):
+            batch = random.sample(comments, min(comments_per_request, len(comments)))
+            start = time.monotonic()
+            status, _ = await http_request(reader, writer, 'POST', '/score', {'comments': batch})
+            if status == 200:
+                latencies.append(time.monotonic() - start)
+            else:
+                failures.append(status)
+    finally:
+        writer.close()
+
+
+async def generate_load(comments, host=SCORING_HOST, port=SCORING_PORT, concurrency=LOAD_CONCURRENCY,
+                        requests=LOAD_REQUESTS, comments_per_request=LOAD_COMMENTS_PER_REQUEST):
+    """
+    :return: client side throughput and latency percentiles, plus the server's own /stats
+    :rtype: dict
+    """
+    latencies = []
+    failures = []
+    start = time.monotonic()
+    per_client = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    await asyncio.gather(*(client(host, port, comments, n, comments_per_request, latencies, failures)
+                           for n in per_client if n))
+    elapsed = time.monotonic() - start
+    reader, writer = await asyncio.open_connection(host, port)
+    _, server_stats = await http_request(reader, writer, 'GET', '/stats')
+    writer.close()
+    latencies.sort()
+    return {'requests': len(latencies), 'failures': len(failures), 'seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed,
+            'comments_per_second': len(latencies) * comments_per_request / elapsed,
+            'latency_ms': {'p50': percentile(latencies, 0.5) * 1000, 'p90': percentile(latencies, 0.9) * 1000,
+                           'p99': percentile(latencies, 0.99) * 1000} if latencies else None,
+            'server': server_stats}
+
+
+if __name__ == "__main__":
+    SAMPLE_DATA_FILE = './data/sample.csv'
+
+    report = asyncio.get_event_loop().run_until_complete(generate_load(load_comments(SAMPLE_DATA_FILE)))
+    print(json.dumps(report, indent=2))
@@ -1,35 +1,120 @@
 import numpy as np
 from gensim import corpora
+from gensim import matutils
 from gensim import models
+from gensim.models.tfidfmodel import precompute_idfs
 from keras.preprocessing.text import text_to_word_sequence
 
+from instrumentation import instrumented
 from tf_idf_model import tf_idf_vectorizer_big
 from utils import COMMENT_TEXT_INDEX, load_data, dataframe_to_list
 
+LSI_NUM_TOPICS = 300
 
+
+class LsiFeaturizer(object):
+    """
+    Training dictionary, tf-idf weights and LSI projection kept together, so a batch of documents is projected with
+    a single sparse x dense matmul against the stored left singular vectors instead of one lsi[doc] call per row.
+    """
+
+    def __init__(self, num_topics=LSI_NUM_TOPICS):
+        self.num_topics = num_topics
+        self.dictionary = None
+        self.tfidf = None
+        self.lsi = None
+        # float32 copy of the left singular vectors, made once per fit or update rather than for every batch
+        self.projection = None
+
+    def bow_corpus(self, lst):
+        texts = [text_to_word_sequence(sentence) for sentence in lst]
+        return [self.dictionary.doc2bow(text) for text in texts]
+
+    def tfidf_matrix(self, corpus):
+        """:return: tf-idf weighted (N, num_terms) matrix of a bow corpus"""
+        # only the terms the projection was fitted on can be projected
+        num_terms = self.lsi.num_terms
+        corpus = [[(term_id, count) for term_id, count in bow if term_id < num_terms] for bow in corpus]
+        return matutils.corpus2csc(self.tfidf[corpus], num_terms=num_terms, num_docs=len(corpus),
+                                   dtype=np.float32).T.tocsr()
+
+    def build_projection(self):
+        self.projection = self.lsi.projection.u[:, :self.num_topics].astype(np.float32)
+
+    def project(self, corpus):
+        # same as lsi[doc] (unscaled) for every doc at once, zero padded when the fit found fewer than num_topics
+        topics = np.zeros((len(corpus), self.num_topics), dtype=np.float32)
+        topics[:, :self.projection.shape[1]] = self.tfidf_matrix(corpus).dot(self.projection)
+        return topics
+
+    def __getstate__(self):
+        # the copy is rebuilt on load instead of doubling the size of the pickle
+        state = dict(self.__dict__)
+        state['projection'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.lsi is not None:
+            self.build_projection()
+
+    def fit(self, lst):
+        return self.fit_corpus(lst)[0]
+
+    def fit_corpus(self, lst):
+        self.dictionary = corpora.Dictionary(text_to_word_sequence(sentence) for sentence in lst)
+        corpus = self.bow_corpus(lst)
+        self.tfidf = models.TfidfModel(corpus)
+        self.lsi = models.LsiModel(self.tfidf[corpus], id2word=self.dictionary, num_topics=self.num_topics)
+        self.build_projection()
+        return self, corpus
+
+    def fit_transform(self, lst):
+        _, corpus = self.fit_corpus(lst)
+        return self.project(corpus)
+
+    def transform(self, lst):
+        return self.project(self.bow_corpus(lst))
+
+    def update(self, lst):
+        """
+        fold a newly labelled batch into the stored statistics and decomposition, cost is proportional to the batch
+
+        New words join the dictionary and the idf statistics, but are only projected after a full refit since the
+        stored projection has no row for them.
+        :return: topics of the new batch
+        """
+        texts = [text_to_word_sequence(sentence) for sentence in lst]
+        self.dictionary.add_documents(texts)
+        corpus = [self.dictionary.doc2bow(text) for text in texts]
+        # the tf-idf model was initialised from the same corpus as the dictionary, so their document counts agree
+        self.tfidf.dfs = dict(self.dictionary.dfs)
+        self.tfidf.num_docs = self.dictionary.num_docs
+        self.tfidf.idfs = precompute_idfs(self.tfidf.wglobal, self.tfidf.dfs, self.tfidf.num_docs)
+        num_terms = self.lsi.num_terms
+        known_corpus = [[(term_id, count) for term_id, count in bow if term_id < num_terms] for bow in corpus]
+        self.lsi.add_documents(self.tfidf[known_corpus])
+        self.build_projection()
+        return self.project(corpus)
+
+
+@instrumented("lsi fit")
 def build_LSI_model(lst):
-    texts = [text_to_word_sequence(sentence) for sentence in lst]
-    dictionary = corpora.Dictionary(texts)
-    corpus = [dictionary.doc2bow(text) for text in texts]
-    tfidf = models.TfidfModel(corpus)
-    corpus_tfidf = tfidf[corpus]
-    lsi = models.LsiModel(corpus_tfidf, id2word=dictionary, num_topics=300)
-    results_vector = []
-    for text in corpus:
-        vector = [i[1] for i in lsi[text]]
-        results_vector.append(np.array(vector))
-    return lsi, np.array(results_vector)
-
-
-def predict_LSI_model(lsi, lst):
-    texts = [text_to_word_sequence(sentence) for sentence in lst]
-    dictionary = corpora.Dictionary(texts)
-    corpus = [dictionary.doc2bow(text) for text in texts]
-    results_vector = []
-    for text in corpus:
-        vector = [i[1] for i in lsi[text]]
-        results_vector.append(np.array(vector))
-    return np.array(results_vector)
+    """
+    :return: fitted featurizer and the fixed-shape float32 (N, LSI_NUM_TOPICS) topics of lst
+    :rtype: LsiFeaturizer, np.ndarray
+    """
+    featurizer = LsiFeaturizer()
+    topics = featurizer.fit_transform(lst)
+    return featurizer, topics
+
+
+def predict_LSI_model(featurizer, lst):
+    return featurizer.transform(lst)
+
+
+def update_LSI_model(featurizer, lst):
+    return featurizer.update(lst)
 
 
 if __name__ == "__main__":
@@ -37,5 +122,5 @@ if __name__ == "__main__":
     DATA_FILE = './data/balanced_train_file.csv'
     df = load_data(DATA_FILE)
     lst = dataframe_to_list(df[COMMENT_TEXT_INDEX])
-    sparse_word = tf_idf_vectorizer_big(lst)
+    sparse_word, vect_char, vect_word = tf_idf_vectorizer_big(lst)
     lsi = build_LSI_model(lst)
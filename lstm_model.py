@@ -1,25 +1,31 @@
 import os
 import pickle
 import time
+import weakref
 
 import keras.callbacks
 import numpy as np
+import tensorflow as tf
+from keras import backend as K
 from keras.layers import Dense
-from keras.layers import GRU, Embedding
+from keras.layers import GRU, Embedding, Input
 from keras.models import Model
 from keras.models import Sequential
 from keras.preprocessing import sequence
 from sklearn.metrics import confusion_matrix, classification_report
 from sklearn.model_selection import train_test_split
 
-from utils import transform_text_in_df_return_w2v_np_vectors, chunks
+from instrumentation import timed, describe
+from utils import transform_text_in_df_return_w2v_np_vectors, transform_text_in_df_return_w2v_indices, \
+    build_w2v_embedding_matrix
 
 PATIENCE = 10
 
 TRAINING_TIME_EPOCHS = 500
 
 W2V_TF_BATCH_SIZE = 1000
-W2V_GENERATOR_BATCH_SIZE = 10000
+FEEDER_WORKERS = 4
+FEEDER_USE_MULTIPROCESSING = False
 
 X_TRAIN_DATA_INDEX = 0
 X_TEST_DATA_INDEX = 1
@@ -37,48 +43,280 @@ TRAIN_HISTORY_DICT_PATH = 'keras_models/{}/trainHistoryDict'
 MODEL_SAVE_PATH = 'keras_models/{}/keras_model.h5'
 
 MAX_W2V_LENGTH = 300
-import tensorflow as tf
-
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = True
-session = tf.Session(config=config)
+W2V_EMBEDDING_LAYER_NAME = 'w2v_embedding'
+MULTI_TASK_MODEL_KEY = 'all_labels'
+GRU_BUCKET_LENGTHS = (25, 50, 100, 200, 300)
+PREDICT_BATCH_SIZE = 4096
+FEATURE_LAYER_SUFFIX = '_features'
+
+# 0 lets tensorflow pick, which is every core for each op pool
+TF_INTRA_OP_THREADS = 0
+TF_INTER_OP_THREADS = 0
+
+# truncated feature models per trained model, dropped together with the model
+_feature_extractors = weakref.WeakKeyDictionary()
+
+
+def configure_session(intra_op_threads=TF_INTRA_OP_THREADS, inter_op_threads=TF_INTER_OP_THREADS):
+    """
+    run keras on a session with explicit thread pools, has to be called before any model is built or loaded
+
+    :param intra_op_threads: threads a single op (e.g. one GRU matmul) is split across
+    :param inter_op_threads: independent ops run at the same time
+    """
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+    config.gpu_options.allow_growth = True
+    session = tf.Session(config=config)
+    K.set_session(session)
+    return session
+
+
+def feature_extractor(model, keys=None):
+    """
+    model cut at the features the wide network is trained on, built once per model and reused by later calls
+
+    :param keys: labels of a multi-task model, their label + FEATURE_LAYER_SUFFIX layers are the outputs. None takes
+    the penultimate layer of a single label model
+    """
+    extractors = _feature_extractors.setdefault(model, {})
+    cache_key = tuple(keys) if keys is not None else None
+    if cache_key not in extractors:
+        if keys is None:
+            outputs = model.get_layer(index=-2).output
+        else:
+            outputs = [model.get_layer(key + FEATURE_LAYER_SUFFIX).output for key in keys]
+        extractor = Model(inputs=model.input, outputs=outputs)
+        # build the predict function now instead of inside the first timed call
+        extractor._make_predict_function()
+        extractors[cache_key] = extractor
+    return extractors[cache_key]
+
+
+def sequence_lengths(x, rows, chunk_size=W2V_TF_BATCH_SIZE):
+    """timesteps after the leading (pre) padding of every row, padding is 0 ids or all zero vectors"""
+    if not isinstance(x, np.ndarray):
+        return np.array([len(x[row]) for row in rows], dtype='int32')
+    lengths = []
+    # in chunks, x may be a memory-mapped float array far bigger than memory
+    for i in range(0, len(rows), chunk_size):
+        batch = x[rows[i:i + chunk_size]]
+        if batch.ndim == 3:
+            batch = np.any(batch, axis=2)
+        nonzero = batch != 0
+        lengths.append(np.where(nonzero.any(axis=1), batch.shape[1] - nonzero.argmax(axis=1), 0))
+    return np.concatenate(lengths) if lengths else np.zeros(0, dtype='int32')
+
+
+class GruBatchSequence(keras.utils.Sequence):
+    """
+    Builds every batch on demand, so training memory is bounded by the batch size instead of the corpus.
+
+    x is either a padded id matrix, a float array, or a list of ragged token id arrays that are padded to maxlen per
+    batch. indices restricts the feeder to a subset of rows (e.g. a train/validation split) without copying x.
+
+    With bucket_lengths, rows are grouped by length and every batch is cut to the smallest bucket that fits its
+    rows (pre-padding keeps the tokens at the end), so the GRUs do not run over padding. The model needs a variable
+    number of timesteps (max_len=None). Batches then no longer come in row order, use predict_sequence to predict.
+    """
+
+    def __init__(self, x, y=None, batch_size=NOVEL_TF_BATCH_SIZE, maxlen=None, indices=None,
+                 shuffle=False, bucket_lengths=None, seed=42):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+        self.shuffle = shuffle
+        self.bucket_lengths = sorted(bucket_lengths) if bucket_lengths else None
+        self.random_state = np.random.RandomState(seed)
+        self.indices = np.arange(len(x)) if indices is None else np.array(indices)
+        self.lengths = sequence_lengths(x, self.indices) if bucket_lengths else None
+        self.batches = self.make_batches()
+
+    def make_batches(self):
+        """:return: (positions into self.indices, timesteps to cut the batch to) per batch"""
+        positions = np.arange(len(self.indices))
+        if self.bucket_lengths is None:
+            if self.shuffle:
+                self.random_state.shuffle(positions)
+            return [(positions[i:i + self.batch_size], self.maxlen)
+                    for i in range(0, len(positions), self.batch_size)]
+        # smallest bucket that holds the row, longer rows are truncated to the largest bucket
+        bucket_of_row = np.minimum(np.searchsorted(self.bucket_lengths, self.lengths), len(self.bucket_lengths) - 1)
+        batches = []
+        for bucket, bucket_length in enumerate(self.bucket_lengths):
+            bucket_positions = positions[bucket_of_row == bucket]
+            if self.shuffle:
+                self.random_state.shuffle(bucket_positions)
+            batches.extend((bucket_positions[i:i + self.batch_size], bucket_length)
+                           for i in range(0, len(bucket_positions), self.batch_size))
+        if self.shuffle:
+            self.random_state.shuffle(batches)
+        return batches
+
+    def __len__(self):
+        return len(self.batches)
+
+    def batch_rows(self, index):
+        return self.indices[self.batches[index][0]]
+
+    def positions(self):
+        """position in indices of every row, in the order the batches produce them"""
+        return np.concatenate([positions for positions, _ in self.batches])
+
+    def __getitem__(self, index):
+        rows = self.batch_rows(index)
+        timesteps = self.batches[index][1]
+        if isinstance(self.x, np.ndarray):
+            x = self.x[rows]
+            if timesteps is not None and timesteps < x.shape[1]:
+                x = x[:, -timesteps:]
+        else:
+            x = sequence.pad_sequences([self.x[row] for row in rows], maxlen=timesteps)
+        if self.y is None:
+            return x
+        if isinstance(self.y, dict):  # one target per named output of a multi-task model
+            return x, {key: value[rows] for key, value in self.y.items()}
+        return x, self.y[rows]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.batches = self.make_batches()
+
+
+def predict_sequence(model, prediction_sequence, workers=FEEDER_WORKERS,
+                     use_multiprocessing=FEEDER_USE_MULTIPROCESSING):
+    """:return: model output for the rows of an unshuffled feeder, in the order of its indices even when bucketed"""
+    outputs = model.predict_generator(prediction_sequence, steps=len(prediction_sequence), workers=workers,
+                                      use_multiprocessing=use_multiprocessing)
+    positions = prediction_sequence.positions()
+
+    def reorder(output):
+        ordered = np.empty_like(output)
+        ordered[positions] = output
+        return ordered
+
+    if isinstance(outputs, list):
+        return [reorder(output) for output in outputs]
+    return reorder(outputs)
+
+
+def train_gru_models(build_model, x, truth_dictionary, batch_size, number_of_epochs, maxlen=None,
+                     workers=FEEDER_WORKERS, use_multiprocessing=FEEDER_USE_MULTIPROCESSING, multi_task=False,
+                     bucket_lengths=None, logger=None):
+    """
+    :param build_model: returns a fresh compiled model, called once per label, or once if multi_task
+    :param x: model input for every row, see GruBatchSequence
+    :param multi_task: build_model returns one model with an output per label (build_keras_multi_task_model)
+    :param bucket_lengths: batch rows of similar length together, see GruBatchSequence
+    :return: trained model per label, or {MULTI_TASK_MODEL_KEY: model} if multi_task
+    :rtype: dict
+    """
+    # same split as train_test_split on the arrays themselves, without copying them
+    train_index, test_index = train_test_split(np.arange(len(x)), test_size=0.1, random_state=42)
+    if multi_task:
+        logger.info("training multi-task network for %s", list(truth_dictionary))
+        model = fit_gru_model(build_model(), MULTI_TASK_MODEL_KEY, x, truth_dictionary, truth_dictionary, batch_size,
+                              number_of_epochs, train_index, test_index, maxlen=maxlen, workers=workers,
+                              use_multiprocessing=use_multiprocessing, bucket_lengths=bucket_lengths, logger=logger)
+        return {MULTI_TASK_MODEL_KEY: model}
+    model_dict = {}
+    for key in truth_dictionary:
+        logger.info("training %s network", key)
+        model_dict[key] = fit_gru_model(build_model(), key, x, truth_dictionary[key], {key: truth_dictionary[key]},
+                                        batch_size, number_of_epochs, train_index, test_index, maxlen=maxlen,
+                                        workers=workers, use_multiprocessing=use_multiprocessing,
+                                        bucket_lengths=bucket_lengths, logger=logger)
+    return model_dict
+
+
+def fit_gru_model(model, name, x, truth_labels, validation_labels, batch_size, number_of_epochs, train_index,
+                  test_index, maxlen=None, workers=FEEDER_WORKERS, use_multiprocessing=FEEDER_USE_MULTIPROCESSING,
+                  bucket_lengths=None, logger=None):
+    """
+    fit model with early stopping on the held out rows, then log the confusion matrix and classification report of
+    every output on them
+
+    :param name: model key in the logs and timers
+    :param truth_labels: labels the GruBatchSequence feeds, one array, or the truth dictionary of a multi-task model
+    :param validation_labels: label -> truth array of every model output, in output order
+    :return: the fitted model
+    """
+    train_sequence = GruBatchSequence(x, truth_labels, batch_size=batch_size, maxlen=maxlen, indices=train_index,
+                                      shuffle=True, bucket_lengths=bucket_lengths)
+    test_sequence = GruBatchSequence(x, truth_labels, batch_size=batch_size, maxlen=maxlen, indices=test_index,
+                                     bucket_lengths=bucket_lengths)
+    early_stop_callback = keras.callbacks.EarlyStopping(monitor='val_loss', patience=PATIENCE, verbose=0,
+                                                        mode='auto')
+    with timed("gru fit " + name, rows=len(train_index), logger=logger):
+        history = model.fit_generator(train_sequence, steps_per_epoch=len(train_sequence), epochs=number_of_epochs,
+                                      callbacks=[early_stop_callback, ], validation_data=test_sequence,
+                                      validation_steps=len(test_sequence), workers=workers,
+                                      use_multiprocessing=use_multiprocessing)
+    logger.info(str(history.history))
+    logger.info("number of epochs completed is %s", len(history.history['loss']))
+    prediction_sequence = GruBatchSequence(x, batch_size=batch_size, maxlen=maxlen, indices=test_index,
+                                           bucket_lengths=bucket_lengths)
+    with timed("gru validation predict " + name, rows=len(test_index), logger=logger):
+        predictions = predict_sequence(model, prediction_sequence, workers=workers,
+                                       use_multiprocessing=use_multiprocessing)
+    # a model with a single output returns its array rather than a list of one
+    if len(validation_labels) == 1:
+        predictions = [predictions]
+    for key, prediction in zip(validation_labels, predictions):
+        validation = (prediction > 0.5).astype('int32')
+        y_test = validation_labels[key][test_index]
+        logger.info('\nConfusion matrix for %s\n %s', key, confusion_matrix(y_test, validation))
+        logger.info('classification report for %s\n %s', key, classification_report(y_test, validation))
+    return model
 
 
-def lstm_main(summarized_sentences, truth_dictionary, w2v_model, testing, use_w2v=True, logger=None):
+def lstm_main(summarized_sentences, truth_dictionary, w2v_model, testing, use_w2v=True, use_w2v_indices=False,
+              workers=FEEDER_WORKERS, use_multiprocessing=FEEDER_USE_MULTIPROCESSING, multi_task=False,
+              bucketed=False, n_jobs=None, logger=None):
+    """:param n_jobs: tokenizer processes of the w2v input, None for one per core"""
     if testing:
         logger.info("running tests")
-        grand_number_of_epochs = 1
         number_of_epochs = 10
     else:
         logger.info("running eval")
-        grand_number_of_epochs = 1
         number_of_epochs = TRAINING_TIME_EPOCHS
 
+    # bucketed models take any number of timesteps, every batch is only as long as its longest comment's bucket
+    bucket_lengths = GRU_BUCKET_LENGTHS if bucketed else None
+    w2v_max_len = None if bucketed else MAX_W2V_LENGTH
+    novel_max_len = None if bucketed else MAX_NUM_WORDS_ONE_HOT
+
     # process data
     logger.info("processing data")
-    if use_w2v:
-        np_vector_array = transform_text_in_df_return_w2v_np_vectors(summarized_sentences, w2v_model)
-        model_dict = {}
-        for key in truth_dictionary:
-            x_train, x_test, y_train, y_test = train_test_split(np_vector_array, truth_dictionary[key],
-                                                                test_size=0.1,
-                                                                random_state=42)
-
-            model = build_keras_model(max_len=MAX_W2V_LENGTH)
-            logger.info("training w2v network")
-            early_stop_callback = keras.callbacks.EarlyStopping(monitor='val_loss', patience=PATIENCE, verbose=0,
-                                                                mode='auto')
-
-            history = model.fit(x_train, y_train, batch_size=W2V_TF_BATCH_SIZE, epochs=number_of_epochs,
-                                callbacks=[early_stop_callback, ], validation_data=(x_test, y_test))
-            logger.info(str(history.history))
-            logger.info('getting w2v results')
-            logger.info("number of epochs completed is" + str(len(history.history['loss'])))
-            validation = model.predict_classes(x_test)
-            logger.info('\nConfusion matrix\n %s', confusion_matrix(y_test, validation))
-            logger.info('classification report\n %s', classification_report(y_test, validation))
-            model_dict[key] = model
-            # try some values
+    if use_w2v and use_w2v_indices:
+        # (N, MAX_W2V_LENGTH) row ids, the vectors are gathered by a frozen embedding layer inside the model
+        with timed("w2v index transform", rows=len(summarized_sentences), logger=logger) as record:
+            np_index_array, w2v_vocabulary = transform_text_in_df_return_w2v_indices(summarized_sentences, w2v_model,
+                                                                                     n_jobs=n_jobs)
+            embedding_matrix = build_w2v_embedding_matrix(w2v_vocabulary, w2v_model)
+            record['output'] = describe((np_index_array, embedding_matrix))
+        if multi_task:
+            build_model = lambda: build_keras_multi_task_model(max_len=w2v_max_len, labels=list(truth_dictionary),
+                                                               embedding_matrix=embedding_matrix)
+        else:
+            build_model = lambda: build_keras_model(max_len=w2v_max_len, embedding_matrix=embedding_matrix)
+        model_dict = train_gru_models(build_model, np_index_array, truth_dictionary, W2V_TF_BATCH_SIZE,
+                                      number_of_epochs, workers=workers, use_multiprocessing=use_multiprocessing,
+                                      multi_task=multi_task, bucket_lengths=bucket_lengths, logger=logger)
+        return np_index_array, model_dict, w2v_vocabulary
+    elif use_w2v:
+        with timed("w2v vector transform", rows=len(summarized_sentences), logger=logger) as record:
+            np_vector_array = transform_text_in_df_return_w2v_np_vectors(summarized_sentences, w2v_model,
+                                                                         n_jobs=n_jobs)
+            record['output'] = describe(np_vector_array)
+        if multi_task:
+            build_model = lambda: build_keras_multi_task_model(max_len=w2v_max_len, labels=list(truth_dictionary))
+        else:
+            build_model = lambda: build_keras_model(max_len=w2v_max_len)
+        model_dict = train_gru_models(build_model, np_vector_array, truth_dictionary, W2V_TF_BATCH_SIZE,
+                                      number_of_epochs, workers=workers, use_multiprocessing=use_multiprocessing,
+                                      multi_task=multi_task, bucket_lengths=bucket_lengths, logger=logger)
         return np_vector_array, model_dict
     else:
         from keras.preprocessing.text import Tokenizer
@@ -88,82 +326,64 @@ def lstm_main(summarized_sentences, truth_dictionary, w2v_model, testing, use_w2
                               lower=True,
                               split=" ",
                               char_level=False)
-        tokenizer.fit_on_texts(summarized_sentences)
-        transformed_text = tokenizer.texts_to_sequences(summarized_sentences)
-        for index, text in enumerate(transformed_text):
-            transformed_text[index] = np.array(text, dtype='int32')
-        transformed_text = np.array(transformed_text)
-        padded_text = []
-        for chunk in chunks(transformed_text, 10):
-            padded_text.extend(sequence.pad_sequences(chunk, maxlen=MAX_NUM_WORDS_ONE_HOT))
-        padded_text = np.array(padded_text)
-
-        vocab_size = len(tokenizer.word_counts)
-        model_dict = {}
-        for key in truth_dictionary:
-            x_train, x_test, y_train, y_test = train_test_split(padded_text, truth_dictionary[key],
-                                                                test_size=0.1,
-                                                                random_state=42)
-            logger.info("training novel network")
-            model = build_keras_embeddings_model(max_vocab_size=vocab_size, max_length=MAX_NUM_WORDS_ONE_HOT)
-            logger.info("vocab size is" + str(vocab_size))
-            early_stop_callback = keras.callbacks.EarlyStopping(monitor='val_loss', patience=PATIENCE, verbose=0,
-                                                                mode='auto')
-
-            history = model.fit(x_train, y_train, batch_size=NOVEL_TF_BATCH_SIZE, epochs=number_of_epochs,
-                                callbacks=[early_stop_callback, ], validation_data=(x_test, y_test))
-            logger.info(str(history.history))
-            logger.info("number of epochs completed is" + str(len(history.history['loss'])))
-            validation = model.predict_classes(x_test)
-            logger.info('getting w2v results')
-            logger.info('\nConfusion matrix\n', confusion_matrix(y_test, validation))
-            logger.info("classificaiton report", classification_report(y_test, validation))
-            model_dict[key] = model
+        with timed("tokenizer fit and transform", rows=len(summarized_sentences), logger=logger) as record:
+            tokenizer.fit_on_texts(summarized_sentences)
+            transformed_text = [np.array(text, dtype='int32')
+                                for text in tokenizer.texts_to_sequences(summarized_sentences)]
+            record['output'] = describe(transformed_text)
+
+        # ids run from 1 to len(word_index), capped below num_words by texts_to_sequences, 0 is padding
+        vocab_size = min(len(tokenizer.word_index) + 1, MAX_VOCAB_SIZE)
+        logger.info("vocab size is %s", vocab_size)
+        # the ragged ids are padded per batch by the feeder, the padded copy is only kept for lstm_predict
+        if multi_task:
+            build_model = lambda: build_keras_multi_task_model(max_len=novel_max_len,
+                                                               labels=list(truth_dictionary),
+                                                               max_vocab_size=vocab_size)
+        else:
+            build_model = lambda: build_keras_embeddings_model(max_vocab_size=vocab_size,
+                                                               max_length=novel_max_len)
+        model_dict = train_gru_models(build_model, transformed_text, truth_dictionary, NOVEL_TF_BATCH_SIZE,
+                                      number_of_epochs, maxlen=MAX_NUM_WORDS_ONE_HOT, workers=workers,
+                                      use_multiprocessing=use_multiprocessing, multi_task=multi_task,
+                                      bucket_lengths=bucket_lengths, logger=logger)
+        padded_text = sequence.pad_sequences(transformed_text, maxlen=MAX_NUM_WORDS_ONE_HOT)
         return padded_text, model_dict, tokenizer
 
 
-def lstm_predict(model_dict, predicted_data, truth_dictionary, use_w2v=True, logger=None):
-    if use_w2v:
-        padded_x_test = predicted_data
-        results_dict = {}
-        for key in truth_dictionary:
-            model = model_dict[key]
-            intermediate_layer_model = Model(inputs=model.input,
-                                             outputs=model.get_layer(index=-2).output)
-            intermediate_output = intermediate_layer_model.predict(padded_x_test)
-            results_dict[key] = np.array(intermediate_output)
+def lstm_predict(model_dict, predicted_data, truth_dictionary, use_w2v=True, bucketed=False,
+                 batch_size=PREDICT_BATCH_SIZE, logger=None):
+    """
+    :param bucketed: predict comments of similar length together, cut to their bucket, the models must have been
+    built with a variable number of timesteps (lstm_main(..., bucketed=True))
+    :param batch_size: rows per forward pass, inference holds no gradients so this can be far above training's
+    :return: penultimate layer output per label, rows in the order of predicted_data
+    """
+    dtype = 'float32' if use_w2v else 'float16'
+    multi_task = MULTI_TASK_MODEL_KEY in model_dict
+    if multi_task:
+        # one forward pass through the shared encoder gives every label's head features
+        jobs = [(model_dict[MULTI_TASK_MODEL_KEY], list(truth_dictionary))]
     else:
-        padded_x_test = predicted_data
-        results_dict = {}
-        for key in truth_dictionary:
-            model = model_dict[key]
-            intermediate_layer_model = Model(inputs=model.input,
-                                             outputs=model.get_layer(index=-2).output)
-            intermediate_output = intermediate_layer_model.predict(padded_x_test)
-            results_dict[key] = np.array(intermediate_output, dtype='float16')
+        jobs = [(model_dict[key], [key]) for key in truth_dictionary]
+
+    results_dict = {}
+    for model, labels in jobs:
+        extractor = feature_extractor(model, labels if multi_task else None)
+        with timed("gru features for " + ", ".join(labels), rows=len(predicted_data), logger=logger) as record:
+            if bucketed:
+                outputs = predict_sequence(extractor, GruBatchSequence(predicted_data, batch_size=batch_size,
+                                                                       bucket_lengths=GRU_BUCKET_LENGTHS))
+            else:
+                outputs = extractor.predict(predicted_data, batch_size=batch_size)
+            if len(labels) == 1:
+                outputs = [outputs]
+            for key, output in zip(labels, outputs):
+                results_dict[key] = np.asarray(output, dtype=dtype)
+            record['output'] = describe({key: results_dict[key] for key in labels})
     return results_dict
 
 
-def w2v_batch_generator(x_train, y_train):
-    batch_size = W2V_GENERATOR_BATCH_SIZE
-    i = batch_size
-    while i < len(x_train) + batch_size:
-        x = sequence.pad_sequences(x_train[i - batch_size:i], maxlen=MAX_W2V_LENGTH, padding='pre', truncating='pre',
-                                   dtype='float16')
-        y = y_train[i - batch_size:i]
-        yield x, y
-        i += batch_size
-
-
-def novel_batch_generator(x_train, y_train):
-    i = NOVEL_TF_BATCH_SIZE
-    while i < len(x_train) + NOVEL_TF_BATCH_SIZE:
-        x = sequence.pad_sequences(x_train[i - NOVEL_TF_BATCH_SIZE:i], maxlen=MAX_NUM_WORDS_ONE_HOT)
-        y = y_train[i - NOVEL_TF_BATCH_SIZE:i]
-        yield x, y
-        i += NOVEL_TF_BATCH_SIZE
-
-
 def save_model_details_and_training_history(expt_name, history, model):
     folder = time.strftime(FILE_NAME_STRING_FORMATING) + FILE_NAME_STRING_DELIMITER + expt_name
     os.makedirs(KERAS_MODEL_DIRECTORY.format(folder), exist_ok=True)
@@ -172,11 +392,57 @@ def save_model_details_and_training_history(expt_name, history, model):
         pickle.dump(history.history, file_pi)
 
 
-def build_keras_model(max_len, testing=False):
+def rebind_w2v_embedding(model, embedding_matrix):
+    """
+    swap the frozen w2v embedding of a model built with build_keras_model(embedding_matrix=...)
+
+    The embedding is not trained, so a model can be re-pointed at a larger vocabulary (e.g. one extended with the
+    words of a prediction file) by rebuilding it with the new input_dim and copying every other layer's weights.
+    """
+    config = model.get_config()
+    layer_configs = config['layers'] if isinstance(config, dict) else config
+    for layer_config in layer_configs:
+        if layer_config['config'].get('name') == W2V_EMBEDDING_LAYER_NAME:
+            layer_config['config']['input_dim'] = embedding_matrix.shape[0]
+    new_model = model.__class__.from_config(config)
+    for new_layer, layer in zip(new_model.layers, model.layers):
+        if new_layer.name == W2V_EMBEDDING_LAYER_NAME:
+            new_layer.set_weights([embedding_matrix])
+        else:
+            new_layer.set_weights(layer.get_weights())
+    return new_model
+
+
+def w2v_embedding_row_writer(model):
+    """
+    :return: write(first_row, vectors), overwriting rows of the model's frozen w2v embedding in place
+
+    The update op is built once, so rows can be rewritten batch after batch (e.g. for each chunk's new words)
+    without rebuilding the model or growing the graph.
+    """
+    embeddings = model.get_layer(W2V_EMBEDDING_LAYER_NAME).embeddings
+    rows = tf.placeholder('int32', shape=(None,))
+    values = tf.placeholder(embeddings.dtype.base_dtype, shape=(None, int(embeddings.shape[1])))
+    update = tf.scatter_update(embeddings, rows, values)
+    session = K.get_session()
+
+    def write(first_row, vectors):
+        session.run(update, feed_dict={rows: np.arange(first_row, first_row + len(vectors)), values: vectors})
+
+    return write
+
+
+def build_keras_model(max_len, testing=False, embedding_matrix=None):
     # expected input data shape: (batch_size, timesteps, data_dim)
+    # or (batch_size, timesteps) of embedding row ids if embedding_matrix is given
     model = Sequential()
 
-    model.add(GRU(300, return_sequences=True, input_shape=(max_len, 300)))
+    if embedding_matrix is not None:
+        model.add(Embedding(embedding_matrix.shape[0], embedding_matrix.shape[1], weights=[embedding_matrix],
+                            input_length=max_len, trainable=False, name=W2V_EMBEDDING_LAYER_NAME))
+        model.add(GRU(300, return_sequences=True))
+    else:
+        model.add(GRU(300, return_sequences=True, input_shape=(max_len, 300)))
     if not testing:
         model.add(GRU(200, return_sequences=True))  # returns a sequence of vectors of dimension 32
         model.add(GRU(128, return_sequences=True))
@@ -208,3 +474,40 @@ def build_keras_embeddings_model(max_vocab_size, max_length, testing=False):
                   optimizer='rmsprop',
                   metrics=['accuracy'])
     return model
+
+
+def build_keras_multi_task_model(max_len, labels, embedding_matrix=None, max_vocab_size=None, testing=False):
+    """
+    one shared GRU encoder with a small head per label, trained once on all labels instead of one stack per label
+
+    input is the same as build_keras_model (w2v vectors, or ids with embedding_matrix) or, with max_vocab_size,
+    build_keras_embeddings_model. Each head is a Dense feature layer named label + FEATURE_LAYER_SUFFIX followed by
+    a sigmoid output named label, lstm_predict takes its features from the former.
+    """
+    if embedding_matrix is not None:
+        inputs = Input(shape=(max_len,), dtype='int32')
+        encoded = Embedding(embedding_matrix.shape[0], embedding_matrix.shape[1], weights=[embedding_matrix],
+                            input_length=max_len, trainable=False, name=W2V_EMBEDDING_LAYER_NAME)(inputs)
+        encoded = GRU(300, return_sequences=True)(encoded)
+    elif max_vocab_size is not None:
+        inputs = Input(shape=(max_len,), dtype='int32')
+        encoded = Embedding(max_vocab_size, 300, input_length=max_len)(inputs)
+    else:
+        inputs = Input(shape=(max_len, 300))
+        encoded = GRU(300, return_sequences=True)(inputs)
+    if not testing:
+        encoded = GRU(200, return_sequences=True)(encoded)
+        encoded = GRU(128, return_sequences=True)(encoded)
+        encoded = GRU(64, return_sequences=True)(encoded)
+        encoded = GRU(64, return_sequences=True)(encoded)
+        encoded = GRU(64, return_sequences=True)(encoded)
+    encoded = GRU(32)(encoded)
+    outputs = []
+    for label in labels:
+        features = Dense(32, activation='relu', name=label + FEATURE_LAYER_SUFFIX)(encoded)
+        outputs.append(Dense(1, activation='sigmoid', name=label)(features))
+    model = Model(inputs=inputs, outputs=outputs)
+    model.compile(loss='binary_crossentropy',
+                  optimizer='rmsprop',
+                  metrics=['accuracy'])
+    return model
@@ -0,0 +1,288 @@
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCORING_HOST = '127.0.0.1'
+SCORING_PORT = 8080
+MAX_BATCH_SIZE = 64
+MAX_BATCH_WAIT = 0.01  # seconds the first comment of a batch waits for others to join it
+LATENCY_WINDOW = 10000  # most recent requests the percentiles are taken over
+MAX_REQUEST_BYTES = 1 << 20
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class LatencyStats(object):
+    """request latencies and batch sizes of the running server, over a sliding window"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.comments = 0
+        self.batches = 0
+        self.errors = 0
+        self.started = time.time()
+
+    def record_request(self, latency, number_of_comments):
+        self.latencies.append(latency)
+        self.requests += 1
+        self.comments += number_of_comments
+
+    def record_batch(self):
+        self.batches += 1
+
+    def summary(self, queue_depth):
+        latencies = sorted(self.latencies)
+        return {'requests': self.requests, 'comments': self.comments, 'batches': self.batches,
+                'errors': self.errors, 'queue_depth': queue_depth,
+                'mean_batch_size': self.comments / self.batches if self.batches else None,
+                'uptime_seconds': time.time() - self.started,
+                'latency_ms': {name: None if value is None else value * 1000 for name, value in (
+                    ('p50', percentile(latencies, 0.5)), ('p90', percentile(latencies, 0.9)),
+                    ('p99', percentile(latencies, 0.99)), ('max', latencies[-1] if latencies else None))}}
+
+
+class MicroBatcher(object):
+    """
+    Coalesces comments submitted by concurrent requests into batches for one score_function call.
+
+    A batch is closed when it holds max_batch_size comments or max_wait seconds after its first comment arrived,
+    whichever comes first. score_function runs on a single worker thread, so keras only ever sees one batch at a
+    time while the next one fills up.
+    """
+
+    def __init__(self, score_function, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT, stats=None):
+        """:param score_function: list of comments -> one row of label probabilities per comment"""
+        self.score_function = score_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats if stats is not None else LatencyStats()
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown()
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def score(self, comments):
+        """:return: probability rows of comments, once the batches holding them have run"""
+        loop = asyncio.get_event_loop()
+        futures = []
+        for comment in comments:
+            future = loop.create_future()
+            self.queue.put_nowait((comment, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # whatever is already queued joins without waiting
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.next_batch()
+            comments = [comment for comment, _ in batch]
+            try:
+                rows = await loop.run_in_executor(self.executor, self.score_function, comments)
+            except Exception as e:
+                self.stats.errors += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats.record_batch()
+            for (_, future), row in zip(batch, rows):
+                if not future.done():  # the client may have gone away
+                    future.set_result([float(value) for value in row])
+
+
+def pipeline_score_function(pipeline):
+    """
+    score_function of a ToxicityPipeline that can be called from the batcher's worker thread
+
+    keras models live in the tensorflow graph and session of the thread that loaded them, so every call re-enters
+    those before predicting.
+    """
+    from keras import backend as K
+
+    session = K.get_session()
+    graph = session.graph
+
+    def score(comments):
+        with graph.as_default(), session.as_default():
+            return pipeline.predict_batch(comments)
+
+    return score
+
+
+class ScoringServer(object):
+    """
+    Minimal HTTP/1.1 JSON server around a MicroBatcher.
+
+    POST /score with {"comments": [...]} (or {"comment": "..."}) returns {"labels": [...], "scores": [[...], ...]},
+    one row of label probabilities per comment. GET /stats returns latency percentiles, queue depth and batch
+    counts, GET /health returns {"status": "ok"}.
+    """
+
+    def __init__(self, batcher, labels, host=SCORING_HOST, port=SCORING_PORT):
+        self.batcher = batcher
+        self.labels = list(labels)
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        # port 0 picks a free port, report the one actually bound
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def read_request(self, reader):
+        """:return: (method, path, headers, body), None once the client closed the connection"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_REQUEST_BYTES:
+            raise ValueError(413)
+        body = await reader.readexactly(length) if length else b''
+        return method, path, headers, body
+
+    async def respond(self, method, path, body):
+        """:return: (status, json serialisable payload)"""
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path == '/stats':
+            return 200, self.batcher.stats.summary(self.batcher.queue_depth)
+        if path != '/score':
+            return 404, {'error': 'unknown path {}'.format(path)}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+        try:
+            request = json.loads(body.decode('utf-8'))
+            comments = request['comments'] if 'comments' in request else [request['comment']]
+            if not all(isinstance(comment, str) for comment in comments):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': 'expected {"comments": [str, ...]} or {"comment": str}'}
+        start = time.monotonic()
+        scores = await self.batcher.score(comments)
+        self.batcher.stats.record_request(time.monotonic() - start, len(comments))
+        return 200, {'labels': self.labels, 'scores': scores}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except ValueError as e:
+                    status = e.args[0] if e.args and e.args[0] in HTTP_REASONS else 400
+                    await self.write_response(writer, status, {'error': 'bad request'}, keep_alive=False)
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                try:
+                    status, payload = await self.respond(method, path, body)
+                except Exception as e:
+                    status, payload = 500, {'error': str(e)}
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self.write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def write_response(self, writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: {}\r\n\r\n'.format(status, HTTP_REASONS[status], len(body),
+                                                     'keep-alive' if keep_alive else 'close').encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+
+def serve(score_function, labels, host=SCORING_HOST, port=SCORING_PORT, max_batch_size=MAX_BATCH_SIZE,
+          max_wait=MAX_BATCH_WAIT, logger=None):
+    """run the scoring server until interrupted"""
+    loop = asyncio.get_event_loop()
+    server = ScoringServer(MicroBatcher(score_function, max_batch_size, max_wait), labels, host, port)
+    loop.run_until_complete(server.start())
+    if logger:
+        logger.info("scoring server listening on %s:%s", host, server.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
+
+
+if __name__ == "__main__":
+    import logging
+
+    from toxicity_pipeline import ToxicityPipeline
+    from utils import load_w2v_model_from_path
+
+    # the pipeline directory main saved for an experiment
+    PIPELINE_DIRECTORY = "./expt/17_03_18_14_20_04_REAL/pipeline/"
+    W2V_MODEL_FILE = './models/w2v.840B.300d.txt'
+    W2V_STORE = './models/w2v.840B.300d.store/'
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server_logger = logging.getLogger("scoring_server")
+    w2v_model = load_w2v_model_from_path(W2V_MODEL_FILE, store_path=W2V_STORE)
+    toxicity_pipeline = ToxicityPipeline.load(PIPELINE_DIRECTORY, w2v_model, logger=server_logger)
+    serve(pipeline_score_function(toxicity_pipeline), toxicity_pipeline.labels, logger=server_logger)
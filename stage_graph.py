@@ -0,0 +1,328 @@
+import hashlib
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import time
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from instrumentation import timed, describe, collect_records
+
+STAGE_CACHE_DIRECTORY = './data/stage_cache/'
+STAGE_OUTPUT_FILE_NAME = 'output.p'
+STAGE_HEADER_FILE_NAME = 'stage.json'
+
+# thread pools of numpy/scipy/sklearn (BLAS, OpenMP) and numexpr, set for every worker from its stage's budget
+STAGE_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def fingerprint_arrays(arrays):
+    """
+    :param arrays: name -> ndarray, e.g. the truth dictionary
+    :return: sha1 hex digest of the names, dtypes, shapes and contents
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        sha1.update(repr((name, array.dtype.str, array.shape)).encode('utf-8'))
+        sha1.update(array.tobytes())
+    return sha1.hexdigest()
+
+
+def code_version(function, module_files=()):
+    """sha1 of the stage function's source and the source files of the modules it relies on"""
+    sha1 = hashlib.sha1(inspect.getsource(function).encode('utf-8'))
+    for module_file in module_files:
+        with open(module_file, 'rb') as f:
+            sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+def save_pickle(output, directory):
+    with open(os.path.join(directory, STAGE_OUTPUT_FILE_NAME), 'wb') as f:
+        pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_pickle(directory):
+    with open(os.path.join(directory, STAGE_OUTPUT_FILE_NAME), 'rb') as f:
+        return pickle.load(f)
+
+
+class Stage(object):
+    """
+    One step of a StageGraph, called as function(*input values, logger=logger, **params).
+
+    :param inputs: names of the sources and stages whose values are passed positionally
+    :param params: hyperparameters, part of the cache key so they have to have a stable repr
+    :param modules: modules whose source is part of the cache key besides the function's own source. Only their
+     source files are kept, modules do not pickle into a worker process
+    :param save: save(output, directory), for outputs that do not pickle (e.g. keras models)
+    :param load: load(directory), inverse of save
+    :param threaded: function also takes threads=, the thread budget of its worker process to size its own pools
+     (n_jobs) by, None when it runs in this process. Not part of the cache key
+    :param worker_setup: worker_setup(threads) is called in the stage's worker process before it runs, e.g. to size a
+     tensorflow session to the thread budget. Not part of the cache key
+    """
+
+    def __init__(self, name, function, inputs=(), params=None, modules=(), save=save_pickle, load=load_pickle,
+                 threaded=False, worker_setup=None):
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.params = params or {}
+        self.module_files = tuple(inspect.getsourcefile(module) for module in modules)
+        self.save = save
+        self.load = load
+        self.threaded = threaded
+        self.worker_setup = worker_setup
+
+
+class StageGraph(object):
+    """
+    Declarative feature pipeline whose stage outputs are cached on disk under a content address.
+
+    A stage's key is derived from its parameters, its code version and the keys of its inputs, which are in turn
+    derived from the fingerprints of the source data. Running the graph only recomputes stages whose key has no
+    cached output, every other stage is loaded, and only if a recomputed stage downstream needs it.
+    """
+
+    def __init__(self, cache_directory=STAGE_CACHE_DIRECTORY, logger=None):
+        self.cache_directory = cache_directory
+        self.logger = logger
+        self.stages = {}
+        self.source_values = {}
+        self.source_fingerprints = {}
+        # stages computed rather than loaded from the cache by this graph, in the order they finished
+        self.computed = []
+        self._keys = {}
+        os.makedirs(cache_directory, exist_ok=True)
+
+    def add_source(self, name, value, fingerprint):
+        """:param fingerprint: identifies value, e.g. fingerprint_texts of the comments"""
+        self.source_values[name] = value
+        self.source_fingerprints[name] = fingerprint
+        self._keys.clear()
+
+    def add_stage(self, name, function, inputs=(), params=None, modules=(), save=save_pickle, load=load_pickle,
+                  threaded=False, worker_setup=None):
+        self.stages[name] = Stage(name, function, inputs, params, modules, save, load, threaded, worker_setup)
+        self._keys.clear()
+        return self.stages[name]
+
+    def key(self, name):
+        if name in self.source_fingerprints:
+            return self.source_fingerprints[name]
+        if name not in self.stages:
+            raise KeyError("no source or stage named {}".format(name))
+        if name not in self._keys:
+            stage = self.stages[name]
+            self._keys[name] = hashlib.sha1(json.dumps({
+                'name': name,
+                'params': repr(sorted(stage.params.items())),
+                'code': code_version(stage.function, stage.module_files),
+                'inputs': [self.key(input_name) for input_name in stage.inputs]}).encode('utf-8')).hexdigest()
+        return self._keys[name]
+
+    def stage_directory(self, name):
+        return os.path.join(self.cache_directory, name, self.key(name))
+
+    def is_cached(self, name):
+        return os.path.exists(os.path.join(self.stage_directory(name), STAGE_HEADER_FILE_NAME))
+
+    def stage_header(self, name):
+        """:return: the header saved with the cached output of stage name, None if it has none"""
+        header_file = os.path.join(self.stage_directory(name), STAGE_HEADER_FILE_NAME)
+        if not os.path.exists(header_file):
+            return None
+        with open(header_file) as f:
+            return json.load(f)
+
+    def save(self, name, output, elapsed, timers=()):
+        """:param timers: instrumentation records of the run that computed output, kept in the header"""
+        directory = self.stage_directory(name)
+        # a half written output from an interrupted run is thrown away, the header is written last
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        self.stages[name].save(output, directory)
+        with open(os.path.join(directory, STAGE_HEADER_FILE_NAME), 'w') as f:
+            json.dump({'name': name, 'key': self.key(name), 'params': repr(sorted(self.stages[name].params.items())),
+                       'inputs': {input_name: self.key(input_name) for input_name in self.stages[name].inputs},
+                       'seconds': elapsed, 'created': time.strftime("%Y-%m-%d %H:%M:%S"), 'timers': list(timers)},
+                      f, default=str)
+
+    def compute(self, name, input_values, threads=None):
+        """:param threads: thread budget passed to a threaded stage, None when it runs in this process"""
+        stage = self.stages[name]
+        params = dict(stage.params, threads=threads) if stage.threaded else stage.params
+        if self.logger:
+            self.logger.info("running stage %s (%s)", name, self.key(name))
+        # the stage's timers, nested ones included, are kept in its header so a worker's outlive the process
+        with collect_records() as timers:
+            with timed("stage " + name, logger=self.logger) as record:
+                output = stage.function(*input_values, logger=self.logger, **params)
+                record['output'] = describe(output)
+        self.save(name, output, record['wall_seconds'], timers)
+        self.computed.append(name)
+        return output
+
+    def run(self, targets):
+        """
+        :param targets: names of the stages whose outputs are wanted
+        :return: output of every target
+        :rtype: dict
+        """
+        values = dict(self.source_values)
+
+        def value(name):
+            if name not in values:
+                stage = self.stages[name]
+                if self.is_cached(name):
+                    if self.logger:
+                        self.logger.info("loading cached stage %s (%s)", name, self.key(name))
+                    values[name] = stage.load(self.stage_directory(name))
+                else:
+                    values[name] = self.compute(name, [value(input_name) for input_name in stage.inputs])
+            return values[name]
+
+        return {name: value(name) for name in targets}
+
+    def pending_stages(self, targets):
+        """:return: the stages that have to run for targets, in dependency order, skipping all behind cached ones"""
+        pending = []
+
+        def visit(name):
+            if name in self.source_fingerprints or name in pending or self.is_cached(name):
+                return
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            pending.append(name)
+
+        for name in targets:
+            visit(name)
+        return pending
+
+    def worker_copy(self, name):
+        """copy of the graph shipped to the worker of stage name, only carrying the sources that stage reads"""
+        copy = object.__new__(StageGraph)
+        copy.__dict__.update(self.__dict__)
+        for input_name in self.stages[name].inputs:
+            self.key(input_name)
+        self.key(name)
+        copy._keys = dict(self._keys)
+        copy.source_values = {input_name: self.source_values[input_name] for input_name in self.stages[name].inputs
+                              if input_name in self.source_values}
+        return copy
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # loggers and their handlers do not cross processes, the worker reopens the same log files
+        logger = state.pop('logger')
+        state['log_spec'] = None if logger is None else (
+            logger.name, logger.level, [(handler.baseFilename, handler.formatter._fmt if handler.formatter else None)
+                                        for handler in logger.handlers if isinstance(handler, logging.FileHandler)])
+        return state
+
+    def __setstate__(self, state):
+        log_spec = state.pop('log_spec')
+        self.__dict__.update(state)
+        self.logger = None
+        if log_spec is not None:
+            name, level, files = log_spec
+            self.logger = logging.getLogger(name)
+            self.logger.setLevel(level)
+            if not self.logger.handlers:
+                for file_name, fmt in files:
+                    handler = logging.FileHandler(file_name)
+                    handler.setFormatter(logging.Formatter(fmt))
+                    self.logger.addHandler(handler)
+
+    def run_parallel(self, targets, max_workers=None, stage_threads=None, default_threads=1, max_threads=None):
+        """
+        run every stage targets need in its own worker process, as many at a time as their inputs and budgets allow
+
+        Stages are independent until they share an input, so e.g. the gazette, LSI and LDA stages run while the GRUs
+        train. Outputs travel between processes through the stage cache only.
+
+        :param max_workers: stages running at the same time, None is one per core
+        :param stage_threads: stage name -> threads that stage's worker may use
+        :param default_threads: threads of a stage missing from stage_threads
+        :param max_threads: total threads of all running stages, None is one per core. A stage whose budget alone is
+        above it still runs, on its own
+        :return: output of every target, as run
+        """
+        cpu_count = multiprocessing.cpu_count()
+        max_workers = max_workers or cpu_count
+        max_threads = max_threads or cpu_count
+        stage_threads = stage_threads or {}
+        pending = self.pending_stages(targets)
+        running = {}
+        # spawn, tensorflow does not survive a fork and every worker has to start with its own thread settings
+        context = multiprocessing.get_context('spawn')
+        try:
+            while pending or running:
+                threads_in_use = sum(threads for _, threads in running.values())
+                running_names = set(name for (name, _), _ in running.values())
+                for name in list(pending):
+                    if len(running) >= max_workers:
+                        break
+                    stage = self.stages[name]
+                    if any(input_name in pending or input_name in running_names for input_name in stage.inputs):
+                        continue
+                    threads = stage_threads.get(name, default_threads)
+                    if running and threads_in_use + threads > max_threads:
+                        continue
+                    process = context.Process(target=run_stage_in_worker, args=(self.worker_copy(name), name, threads),
+                                              name="stage-" + name)
+                    start_with_thread_budget(process, threads)
+                    if self.logger:
+                        self.logger.info("started stage %s with %s threads", name, threads)
+                    pending.remove(name)
+                    running[process.sentinel] = (name, process), threads
+                    running_names.add(name)
+                    threads_in_use += threads
+                if not running:
+                    raise RuntimeError("stages {} can not be scheduled".format(pending))
+                for sentinel in wait(list(running)):
+                    (name, process), _ = running.pop(sentinel)
+                    process.join()
+                    if process.exitcode != 0:
+                        raise RuntimeError("stage {} failed with exit code {}".format(name, process.exitcode))
+                    self.computed.append(name)
+        finally:
+            for (name, process), _ in running.values():
+                process.terminate()
+        return self.run(targets)
+
+
+def start_with_thread_budget(process, threads):
+    """a spawned process copies the environment when it starts, so the budget is only set around start()"""
+    saved = {variable: os.environ.get(variable) for variable in STAGE_THREAD_VARIABLES}
+    os.environ.update({variable: str(threads) for variable in STAGE_THREAD_VARIABLES})
+    try:
+        process.start()
+    finally:
+        for variable, value in saved.items():
+            if value is None:
+                del os.environ[variable]
+            else:
+                os.environ[variable] = value
+
+
+def run_stage_in_worker(graph, name, threads):
+    """entry point of a stage's worker process, reads its inputs from the cache and writes its output to it"""
+    if graph.stages[name].worker_setup is not None:
+        graph.stages[name].worker_setup(threads)
+    input_values = []
+    for input_name in graph.stages[name].inputs:
+        if input_name in graph.source_values:
+            input_values.append(graph.source_values[input_name])
+        else:
+            input_values.append(graph.stages[input_name].load(graph.stage_directory(input_name)))
+    graph.compute(name, input_values, threads)
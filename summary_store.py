@@ -0,0 +1,69 @@
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+from tf_idf_summarizer import summarize_long_sentences
+
+SUMMARY_STORE_FILE = './data/summaries.sqlite'
+SQLITE_MAX_VARIABLES = 900
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class SummaryStore(object):
+    """
+    Append-only sqlite store of comment summaries keyed by (comment id, hash of the comment text).
+
+    A comment whose text changes gets a new key, so it is summarized again while the old summary stays untouched.
+    """
+
+    def __init__(self, store_file=SUMMARY_STORE_FILE):
+        os.makedirs(os.path.dirname(store_file) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(store_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS summaries "
+                                "(comment_id TEXT, text_hash TEXT, summary TEXT, PRIMARY KEY (comment_id, text_hash))")
+
+    def lookup(self, comment_ids, text_hashes):
+        """:return: summary per (id, hash) pair in the given order, None where it is not stored yet"""
+        found = {}
+        unique_ids = list(set(comment_ids))
+        for i in range(0, len(unique_ids), SQLITE_MAX_VARIABLES):
+            batch = unique_ids[i:i + SQLITE_MAX_VARIABLES]
+            query = "SELECT comment_id, text_hash, summary FROM summaries WHERE comment_id IN ({})".format(
+                ",".join("?" * len(batch)))
+            for comment_id, stored_hash, summary in self.connection.execute(query, batch):
+                found[(comment_id, stored_hash)] = summary
+        return [found.get(key) for key in zip(comment_ids, text_hashes)]
+
+    def add(self, comment_ids, text_hashes, summaries):
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO summaries VALUES (?, ?, ?)",
+                                        zip(comment_ids, text_hashes, summaries))
+
+    def summarize(self, comment_ids, texts, summarize_function=summarize_long_sentences):
+        """
+        :param comment_ids: id of every comment
+        :param texts: text of every comment
+        :param summarize_function: called on an object ndarray of the comments that are not stored yet
+        :return: summary of every comment, aligned with comment_ids
+        :rtype: list of str
+        """
+        comment_ids = [str(comment_id) for comment_id in comment_ids]
+        texts = list(texts)
+        text_hashes = [text_hash(text) for text in texts]
+        summaries = self.lookup(comment_ids, text_hashes)
+        missing = [index for index, summary in enumerate(summaries) if summary is None]
+        if missing:
+            new_summaries = summarize_function(np.array([texts[index] for index in missing], dtype=object))
+            self.add([comment_ids[index] for index in missing], [text_hashes[index] for index in missing],
+                     new_summaries)
+            for index, summary in zip(missing, new_summaries):
+                summaries[index] = summary
+        return summaries
+
+    def close(self):
+        self.connection.close()
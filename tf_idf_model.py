@@ -1,11 +1,111 @@
+import os
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
 from scipy import sparse
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import LogisticRegression
+from scipy.special import expit
+import sklearn
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.metrics import confusion_matrix, classification_report
+from sklearn.preprocessing import normalize
 from utils import extract_truth_labels_as_dict
 import re
 
-from utils import COMMENT_TEXT_INDEX, load_data, initalise_logging
+from instrumentation import timed, describe
+
+from utils import COMMENT_TEXT_INDEX, load_data, initalise_logging, chunks
+
+HASH_N_FEATURES = 2 ** 20
+HASH_CHUNK_SIZE = 10000
+# inverse L2 strength of the logistic models, LogisticRegression's default
+LR_C = 1.0
+# SGDClassifier's logistic loss, renamed in scikit-learn 1.1
+SGD_LOG_LOSS = 'log_loss' if tuple(int(part) for part in re.findall(r'\d+', sklearn.__version__)[:2]) >= (1, 1) \
+    else 'log'
+
+
+def search_and_replace_numerals_with_space(x):
+    # module level instead of a lambda so fitted vectorizers can be pickled
+    return re.sub(r'(\d[\d\.])+', '', x.lower())
+
+
+class HashedTfidfVectorizer(object):
+    """
+    Streaming stand-in for TfidfVectorizer.
+
+    Term counts come from a stateless HashingVectorizer, so there is no vocabulary to build; the only fitted state is
+    the per-column document frequency and the document count, accumulated chunk by chunk with partial_fit.
+    Uses the same smooth idf and l2 row normalisation as TfidfVectorizer's defaults.
+    """
+
+    def __init__(self, n_features=HASH_N_FEATURES, min_df=1, chunk_size=HASH_CHUNK_SIZE, dtype=np.float64,
+                 **hashing_params):
+        self.n_features = n_features
+        self.min_df = min_df
+        self.chunk_size = chunk_size
+        self.hashing_vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None,
+                                                    dtype=dtype, **hashing_params)
+        self.document_frequency_ = np.zeros(n_features, dtype=np.int64)
+        self.n_documents_ = 0
+
+    def partial_fit(self, list_of_strings):
+        counts = self.hashing_vectorizer.transform(list_of_strings)
+        self.document_frequency_ += np.bincount(counts.indices, minlength=self.n_features)
+        self.n_documents_ += counts.shape[0]
+        return self
+
+    def fit(self, list_of_strings):
+        for chunk in chunks(list_of_strings, self.chunk_size):
+            self.partial_fit(chunk)
+        return self
+
+    @property
+    def idf_(self):
+        idf = np.log((1.0 + self.n_documents_) / (1.0 + self.document_frequency_)) + 1.0
+        idf[self.document_frequency_ < self.min_df] = 0.0
+        return idf
+
+    def transform(self, list_of_strings):
+        idf = self.idf_
+        blocks = []
+        for chunk in chunks(list_of_strings, self.chunk_size):
+            counts = self.hashing_vectorizer.transform(chunk)
+            counts.data *= idf[counts.indices]
+            counts.eliminate_zeros()
+            blocks.append(normalize(counts, norm='l2', copy=False))
+        return sparse.vstack(blocks, format='csr')
+
+    def fit_transform(self, list_of_strings):
+        return self.fit(list_of_strings).transform(list_of_strings)
+
+    def get_params(self):
+        params = self.hashing_vectorizer.get_params()
+        params.update(min_df=self.min_df, chunk_size=self.chunk_size)
+        return params
+
+
+def tf_idf_vectorizer_hashed(list_of_strings, n_features=HASH_N_FEATURES, chunk_size=HASH_CHUNK_SIZE,
+                             choose_to_log_data=True, logger=None):
+    """
+    bounded-memory alternative to tf_idf_vectorizer_big, same features hashed into n_features columns each
+    :param list_of_strings: corpus, read chunk_size rows at a time
+    :param n_features: hash width of the word and of the char (2, 6)-gram block
+    :return: sparse matrix of shape (N, 2 * n_features), fitted char vectorizer, fitted word vectorizer
+    :rtype: scipy.sparse.csr_matrix, HashedTfidfVectorizer, HashedTfidfVectorizer
+    """
+    vect_char = HashedTfidfVectorizer(n_features=n_features, min_df=20, chunk_size=chunk_size,
+                                      preprocessor=search_and_replace_numerals_with_space,
+                                      analyzer='char', ngram_range=(2, 6))
+    vect_word = HashedTfidfVectorizer(n_features=n_features, min_df=20, chunk_size=chunk_size,
+                                      preprocessor=search_and_replace_numerals_with_space, stop_words='english')
+    sparse_matrix_word = vect_word.fit_transform(list_of_strings)
+    sparse_matrix_char = vect_char.fit_transform(list_of_strings)
+    sparse_matrix_combined = sparse.hstack([sparse_matrix_word, sparse_matrix_char], format='csr')
+    if choose_to_log_data:
+        logger.info("\nhashed vector shape\n %s", sparse_matrix_combined.shape)
+    return sparse_matrix_combined, vect_char, vect_word
 
 
 def tf_idf_vectorizer_big(list_of_strings, choose_to_log_data=True, log_vectorised_words=False, logger=None):
@@ -13,26 +113,63 @@ def tf_idf_vectorizer_big(list_of_strings, choose_to_log_data=True, log_vectoris
     function should return tf-idf logistic regression score
     :param : list
     :type : string
-    :return: sparse matrix
+    :return: sparse matrix, fitted char vectorizer, fitted word vectorizer
     :rtype: value
     """
-    search_and_replace_numerals_with_space = lambda x: re.sub(r'(\d[\d\.])+', '', x.lower())
     vect_char = TfidfVectorizer(preprocessor=search_and_replace_numerals_with_space, stop_words='english',
                                 analyzer='char', ngram_range=(2, 6), min_df=20)
     vect_word = TfidfVectorizer(preprocessor=search_and_replace_numerals_with_space, stop_words='english', min_df=20)
-    sparse_matrix_word = vect_word.fit_transform(list_of_strings)
-    sparse_matrix_char = vect_char.fit_transform(list_of_strings)
+    with timed("tf-idf word fit", rows=len(list_of_strings), logger=logger) as record:
+        sparse_matrix_word = vect_word.fit_transform(list_of_strings)
+        record['output'] = describe(sparse_matrix_word)
+    with timed("tf-idf char fit", rows=len(list_of_strings), logger=logger) as record:
+        sparse_matrix_char = vect_char.fit_transform(list_of_strings)
+        record['output'] = describe(sparse_matrix_char)
+    record_document_frequencies(vect_word, sparse_matrix_word)
+    record_document_frequencies(vect_char, sparse_matrix_char)
     sparse_matrix_combined = sparse.hstack([sparse_matrix_word, sparse_matrix_char])
     if choose_to_log_data:
         logger.info("\nbig vector shape\n %s", sparse_matrix_combined.shape)
     if log_vectorised_words:
         logger.info("\nFeatures of vectorizer_character\n %s", vect_char.get_feature_names())
         logger.info("\nRemoved Features of vectorizer_character \n %s", vect_char.get_stop_words())
-        logger.info("\nHyperparameters of vectorizer_character\n %s", vect_char.fit(list_of_strings))
+        logger.info("\nHyperparameters of vectorizer_character\n %s", vect_char.get_params())
         logger.info("\nFeatures of vectorizer_word\n %s", vect_word.get_feature_names())
         logger.info("\nRemoved Features of vectorizer_word \n %s", vect_word.get_stop_words())
-        logger.info("\nHyperparameters of vectorizer_word\n %s", vect_word.fit(list_of_strings))
-    return sparse_matrix_combined
+        logger.info("\nHyperparameters of vectorizer_word\n %s", vect_word.get_params())
+    return sparse_matrix_combined, vect_char, vect_word
+
+
+def record_document_frequencies(vectorizer, sparse_matrix):
+    """keep the document frequencies a TfidfVectorizer only stores as idf, update_tf_idf_vectorizer needs them"""
+    vectorizer.document_frequency_ = np.bincount(sparse_matrix.tocsr().indices, minlength=sparse_matrix.shape[1])
+    vectorizer.n_documents_ = sparse_matrix.shape[0]
+
+
+def update_tf_idf_vectorizer(vectorizer, new_strings):
+    """
+    add a batch of documents to a fitted vectorizer's idf statistics, the vocabulary (or hash width) stays the same
+    so models trained on its output keep their input width
+    """
+    if isinstance(vectorizer, HashedTfidfVectorizer):
+        return vectorizer.partial_fit(new_strings)
+    new_matrix = vectorizer.transform(new_strings)
+    vectorizer.document_frequency_ += np.bincount(new_matrix.indices, minlength=new_matrix.shape[1])
+    vectorizer.n_documents_ += new_matrix.shape[0]
+    # smooth_idf, same formula as TfidfTransformer
+    idf = np.log((1.0 + vectorizer.n_documents_) / (1.0 + vectorizer.document_frequency_)) + 1.0
+    try:
+        vectorizer.idf_ = idf
+    except AttributeError:  # older sklearn has no idf_ setter
+        vectorizer._tfidf._idf_diag = sparse.diags(idf, offsets=0, shape=(len(idf), len(idf)), format='csr')
+    return vectorizer
+
+
+def transform_tf_idf_big(list_of_strings, vect_char, vect_word):
+    """transform-only counterpart of tf_idf_vectorizer_big/tf_idf_vectorizer_hashed for already fitted vectorizers"""
+    sparse_matrix_word = vect_word.transform(list_of_strings)
+    sparse_matrix_char = vect_char.transform(list_of_strings)
+    return sparse.hstack([sparse_matrix_word, sparse_matrix_char], format='csr')
 
 
 def tf_idf_vectorizer_small(list_of_strings, choose_to_log_data=True, log_vectorised_words=False, logger=None):
@@ -50,29 +187,146 @@ def tf_idf_vectorizer_small(list_of_strings, choose_to_log_data=True, log_vector
     if log_vectorised_words:
         logger.info("\nFeatures of vectorizer_word %s", vect_word.get_feature_names())
         logger.info("\nRemoved Features of vectorizer_word  %s", vect_word.get_stop_words())
-        logger.info("\nHyperparameters of vectorizer_word %s", vect_word.fit(list_of_strings))
+        logger.info("\nHyperparameters of vectorizer_word %s", vect_word.get_params())
     return sparse_matrix_word
 
 
-def build_logistic_regression_model(vector, truth_dictionary, choose_to_log_data=True, logger=None):
+def dump_matrix_for_workers(vector, directory):
+    """write a feature matrix as raw .npy arrays so worker processes can memory-map it instead of receiving a copy"""
+    if sparse.issparse(vector):
+        vector = vector.tocsr()
+        np.save(os.path.join(directory, 'data.npy'), vector.data)
+        np.save(os.path.join(directory, 'indices.npy'), vector.indices)
+        np.save(os.path.join(directory, 'indptr.npy'), vector.indptr)
+        np.save(os.path.join(directory, 'shape.npy'), np.array(vector.shape))
+    else:
+        np.save(os.path.join(directory, 'dense.npy'), np.asarray(vector))
+
+
+def load_shared_matrix(directory):
+    if os.path.exists(os.path.join(directory, 'dense.npy')):
+        return np.load(os.path.join(directory, 'dense.npy'), mmap_mode='r')
+    data = np.load(os.path.join(directory, 'data.npy'), mmap_mode='r')
+    indices = np.load(os.path.join(directory, 'indices.npy'), mmap_mode='r')
+    indptr = np.load(os.path.join(directory, 'indptr.npy'), mmap_mode='r')
+    shape = tuple(np.load(os.path.join(directory, 'shape.npy')))
+    return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def fit_logistic_regression(vector, truth_labels, random_state):
+    # n_jobs has no effect on a binary problem, parallelism comes from fitting the labels in separate processes
+    lr = LogisticRegression(C=LR_C, random_state=random_state, solver='saga')
+    lr.fit(vector, truth_labels)
+    # the weight of the fitted history against a batch folded in by update_logistic_regression_model
+    lr.rows_seen_ = vector.shape[0]
+    return lr, lr.predict_proba(vector)
+
+
+def fit_logistic_regression_on_shared_matrix(args):
+    matrix_directory, truth_labels, random_state = args
+    return fit_logistic_regression(load_shared_matrix(matrix_directory), truth_labels, random_state)
+
+
+def build_logistic_regression_model(vector, truth_dictionary, choose_to_log_data=True, logger=None, n_jobs=1):
+    """
+    :param n_jobs: number of labels fitted at the same time in separate processes, None for one per label. The
+     feature matrix is shared with the workers through memory-mapped files instead of being copied to each one
+    :return: fitted model and training predict_proba output per label
+    :rtype: dict, dict
+    """
+    keys = [str(key) for key in truth_dictionary]
+    rows = vector.shape[0]
+    if n_jobs == 1 or len(keys) == 1:
+        results = []
+        for i, key in enumerate(keys):
+            with timed("logistic regression fit " + key, rows=rows, logger=logger):
+                results.append(fit_logistic_regression(vector, truth_dictionary[key], i))
+    else:
+        # the fits run in the pool, their cpu time shows up as children_cpu_seconds once the pool is closed
+        with timed("logistic regression fit " + ", ".join(keys), rows=rows, logger=logger) as record:
+            with tempfile.TemporaryDirectory() as matrix_directory:
+                dump_matrix_for_workers(vector, matrix_directory)
+                jobs = [(matrix_directory, truth_dictionary[key], i) for i, key in enumerate(keys)]
+                with Pool(min(n_jobs or len(keys), len(keys))) as pool:
+                    results = pool.map(fit_logistic_regression_on_shared_matrix, jobs)
+            record['input'] = describe(vector)
+
     dict_of_pred_probability = {}
     lr_dict = {}
-    for i, key in enumerate(truth_dictionary):
-        lr = LogisticRegression(random_state=i, solver='saga', n_jobs=-1)
-        lr.fit(vector, truth_dictionary[key])
-        pred = lr.predict(vector)
-        key = str(key)
+    for key, (lr, pred_probability) in zip(keys, results):
         if choose_to_log_data:
-            logger.info('print truth_dictornary_column\n %s', truth_dictionary[key])
-            logger.info('print unfitted vector\n %s', vector)
+            # same as lr.predict, without another pass over the matrix
+            pred = lr.classes_[pred_probability.argmax(axis=1)]
+            logger.info('truth labels for %s of shape %s, feature matrix of shape %s', key,
+                        truth_dictionary[key].shape, vector.shape)
             logger.info('\nConfusion matrix\n %s', confusion_matrix(truth_dictionary[key], pred))
             logger.info('print classification report for ' + str(key) + '\n%s',
                         classification_report(truth_dictionary[key], pred))
-        dict_of_pred_probability[key] = lr.predict_proba(vector)
+        dict_of_pred_probability[key] = pred_probability
         lr_dict[key] = lr
     return lr_dict, dict_of_pred_probability
 
 
+def update_logistic_regression_model(lr_dict, vector, truth_dictionary, epochs=1, logger=None):
+    """
+    fold the new batch into every fitted model with SGD, starting from its current coefficients
+
+    A refit on the batch alone would converge to the batch's optimum and lose the history. Instead an SGDClassifier
+    seeded with the model's coefficients continues on the same L2 objective (alpha = 1 / (C * rows seen)) over the
+    batch with partial_fit, at the step size one pass over the history would have decayed to. The coefficients are
+    written back, so lr_dict keeps its fitted LogisticRegression models.
+
+    :param vector: features of the new batch, from the same (updated) vectorizers
+    :param epochs: passes over the new batch
+    :return: the updated lr_dict
+    """
+    rows = vector.shape[0]
+    for key in lr_dict:
+        lr = lr_dict[key]
+        # models saved before rows_seen_ was recorded weigh as much as the batch
+        rows_seen = getattr(lr, 'rows_seen_', rows)
+        sgd = SGDClassifier(loss=SGD_LOG_LOSS, penalty='l2', alpha=1.0 / (LR_C * (rows_seen + rows)))
+        # the classes are known from the fit, a batch with a single class is fine
+        sgd.classes_ = lr.classes_
+        sgd.coef_ = np.array(lr.coef_, dtype=np.float64)
+        sgd.intercept_ = np.array(lr.intercept_, dtype=np.float64)
+        sgd.t_ = float(rows_seen)
+        for _ in range(epochs):
+            sgd.partial_fit(vector, truth_dictionary[key])
+        lr.coef_, lr.intercept_ = sgd.coef_, sgd.intercept_
+        lr.rows_seen_ = rows_seen + rows
+        if logger:
+            logger.info("updated %s with %s rows", key, rows)
+    return lr_dict
+
+
+def export_stacked_logistic_regression(lr_dict, keys=None):
+    """
+    :param lr_dict: fitted binary models from build_logistic_regression_model
+    :param keys: label order of the stacked columns, defaults to lr_dict's order
+    :return: (features x labels) coefficient matrix, (labels,) intercepts, label order
+    :rtype: np.ndarray, np.ndarray, list of str
+    """
+    keys = list(lr_dict) if keys is None else list(keys)
+    for key in keys:
+        assert list(lr_dict[key].classes_) == [0, 1], "stacked scoring expects binary 0/1 models"
+    coefficients = np.vstack([lr_dict[key].coef_[0] for key in keys]).T
+    intercepts = np.array([lr_dict[key].intercept_[0] for key in keys])
+    return coefficients, intercepts, keys
+
+
+def score_stacked_logistic_regression(vector, coefficients, intercepts):
+    """
+    probability of class 1 for every label in one sparse matmul, same as predict_proba(vector)[:, 1] per model
+
+    :return: probabilities of shape (N, labels)
+    :rtype: np.ndarray
+    """
+    if sparse.issparse(vector):
+        vector = vector.tocsr()
+    return expit(vector.dot(coefficients) + intercepts)
+
+
 if __name__ == "__main__":
     SAMPLE_DATA_FILE = './data/sample.csv'
     DATA_FILE = './data/balanced_train_file.csv'
@@ -80,6 +334,6 @@ if __name__ == "__main__":
     train_df = load_data(DATA_FILE)
     train_sentences = train_df[COMMENT_TEXT_INDEX]
     truth_dictionary = extract_truth_labels_as_dict(train_df)
-    vector_big = tf_idf_vectorizer_big(train_sentences, logger=logger)
+    vector_big, vect_char, vect_word = tf_idf_vectorizer_big(train_sentences, logger=logger)
     vector_small = tf_idf_vectorizer_small(train_sentences, logger=logger)
     aggressively_positive_model_report = build_logistic_regression_model(vector_big, truth_dictionary, logger=logger)
@@ -1,80 +1,59 @@
 import re
+from multiprocessing import Pool
 
 import nltk
 from nltk.corpus import stopwords
 
 stop = stopwords.words('english')
-from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
 import numpy as np
 
+from tokenization import tokenize_corpus, SENTENCE_TOKENIZER
+
+SUMMARIZE_CHUNK_SIZE = 100
+
 
 # Noun Part of Speech Tags used by NLTK
 # More can be found here
 # http://www.winwaed.com/blog/2011/11/08/part-of-speech-tags/
 
 
-def summarize_long_sentences(array_of_strings, max_size=300, max_sentences=10):
+def summarize_long_sentences(array_of_strings, max_size=300, max_sentences=10, n_jobs=None):
     assert isinstance(array_of_strings, np.ndarray)
     assert type(array_of_strings[0]) == str
     print("starting summarization")
-    # Load corpus array_of_strings used to train the TF-IDF Transformer
-    training_data = []
-    for index, document in enumerate(array_of_strings):
-        cleaned_document = clean_document(document)
-        training_data.append(cleaned_document)
+    training_data = [clean_document(document) for document in array_of_strings]
     print("done with cleaning")
-    # Merge corpus array_of_strings and new document array_of_strings
-    # Fit and Transform the term frequencies into a vector
-    count_vect = CountVectorizer(stop_words='english')
-    count_vect = count_vect.fit(training_data)
-    freq_term_matrix = count_vect.transform(training_data)
-    feature_names = count_vect.get_feature_names()
-    # Fit and Transform the TfidfTransformer
-    tfidf = TfidfTransformer(norm="l2")
-    tfidf.fit(freq_term_matrix)
-    print("done with fitting")
-    return_list = []
-    # Get the dense tf-idf matrix for the document
-    count = 0
-    split_data_and_shorten_if_needed(count, count_vect, feature_names, max_sentences, return_list, tfidf, training_data)
-    new_list = []
-    for result in return_list:
-        assert type(result[1]) == str
-        new_list.append(result[1])
+    # every long document is sentence split exactly once, across processes and through the token cache
+    long_document_indexes = [index for index, document in enumerate(training_data)
+                             if len(document.split()) > max_size]
+    long_document_sentences = tokenize_corpus([training_data[index] for index in long_document_indexes],
+                                              SENTENCE_TOKENIZER)
+    print("summarizing {} out of {} documents".format(len(long_document_indexes), len(training_data)))
+    jobs = [(training_data[index], sentences, max_size, max_sentences)
+            for index, sentences in zip(long_document_indexes, long_document_sentences)]
+    with Pool(n_jobs) as pool:
+        # map keeps the results in the order of jobs
+        summaries = pool.map(summarize_document, jobs, chunksize=SUMMARIZE_CHUNK_SIZE)
+    new_list = list(training_data)
+    for index, summary in zip(long_document_indexes, summaries):
+        assert type(summary) == str
+        new_list[index] = summary
     assert len(array_of_strings) == len(new_list)
-    print(new_list)
     return new_list
 
 
-def split_data_and_shorten_if_needed(count, count_vect, feature_names, max_sentences, return_list, tfidf,
-                                     training_data):
-    for index, document in enumerate(training_data):
-        if index % 10000 == 0:
-            print("progress : {} out of {}".format(index, len(training_data)))
-        tokenized_sentence = document.split()
-        if len(tokenized_sentence) > 300:
-            count += 1
-            tokenized_sentence_by_sentence = nltk.sent_tokenize(document)
-            if len(tokenized_sentence_by_sentence) == 1 or len(tokenized_sentence_by_sentence) >= 60:  # treash sentence
-                return_list.append((index, " ".join(training_data[index].split()[:300])))
-            else:
-                return_list.append((index, parallel_tf_idf(count_vect, training_data[index], document,
-                                                           feature_names,
-                                                           max_sentences, tfidf)))
-        else:
-            return_list.append((index, training_data[index]))
-    return_list.sort(key=lambda x: x[0])
-
-
-def parallel_tf_idf(count_vect, cleaned_document, document, feature_names, max_sentences, tfidf):
-    story_freq_term_matrix = count_vect.transform([document])
-    story_tfidf_matrix = tfidf.transform(story_freq_term_matrix)
-    story_dense = story_tfidf_matrix.todense()
-    doc_matrix = story_dense.tolist()[0]
-    # Get Top Ranking Sentences and join them as a summary
-    top_sents = rank_sentences(document, doc_matrix, feature_names, top_n=max_sentences)
-    summary = "\n".join([nltk.sent_tokenize(cleaned_document)[i] for i in top_sents])
-    return summary
+def summarize_document(args):
+    """
+    :param args: cleaned document, its sentences, max number of words, max number of sentences
+    :return: the document cut to max_size words if it cannot be split sensibly, else its top ranked sentences
+    :rtype: str
+    """
+    document, sentences, max_size, max_sentences = args
+    if len(sentences) == 1 or len(sentences) >= 60:  # treash sentence
+        return " ".join(document.split()[:max_size])
+    tokenized_sentences = [nltk.word_tokenize(sentence) for sentence in sentences]
+    top_sents = rank_sentences(tokenized_sentences, top_n=max_sentences)
+    return "\n".join([sentences[i] for i in top_sents])
 
 
 def clean_document(document):
@@ -125,34 +104,14 @@ def merge_acronyms(s):
     return s
 
 
-def rank_sentences(doc, doc_matrix, feature_names, top_n=3):
+def rank_sentences(sentences, top_n=3):
     """Returns top_n sentences. Theses sentences are then used as summary
     of document.
     input
     ------------
-    doc : a document as type str
-    doc_matrix : a dense tf-idf matrix calculated with Scikits TfidfTransformer
-    feature_names : a list of all features, the index is used to look up
-                    tf-idf scores in the doc_matrix
+    sentences : the document's sentences, each as a list of word tokens
     top_n : number of sentences to return
     """
-    sents = nltk.sent_tokenize(doc)
-    sentences = [nltk.word_tokenize(sent) for sent in sents]
-    """
-    tfidf_sent = [[doc_matrix[feature_names.index(w.lower())]
-                   for w in sent if w.lower() in feature_names]
-                  for sent in sentences]
-
-    # Calculate Sentence Values
-    doc_val = sum(doc_matrix)
-    sent_values = [sum(sent) / doc_val for sent in tfidf_sent]
-    # Apply Position Weights
-    ranked_sents = [pair for pair in zip(range(len(sent_values)), sent_values)]
-    print(ranked_sents)
-    ranked_sents = sorted(ranked_sents, key=lambda x: x[1] * -1)
-    selected_sents = ranked_sents[:top_n]
-    sentence_indexes = [i[0] for i in selected_sents]
-    """
     sentence_indexes = [0, len(sentences) - 1]
     set_sentences = [set(i) for i in sentences]
     index_sentence_set = set()
@@ -170,12 +129,12 @@ def rank_sentences(doc, doc_matrix, feature_names, top_n=3):
 
 
 if __name__ == "__main__":
-    from utils import load_data, COMMENT_TEXT_INDEX
+    from summary_store import SummaryStore
+    from utils import load_data, COMMENT_TEXT_INDEX, ID_INDEX
 
     data_file = './data/balanced_train_file.csv'
     df = load_data(data_file)
-    list_of_documents = df[COMMENT_TEXT_INDEX].values
-    documents = summarize_long_sentences(list_of_documents)
+    documents = SummaryStore().summarize(df[ID_INDEX], df[COMMENT_TEXT_INDEX])
     size = {}
     for index, document in enumerate(documents):
         length = len(document.split())
@@ -183,11 +142,6 @@ if __name__ == "__main__":
             size[length] += 1
         else:
             size[length] = 1
-        if length > 600:
-            list_of_documents[index] = " ".join(document.split()[:300])
     size_list = [i for i in size.items()]
     size_list.sort(key=lambda x: x[0], reverse=True)
     print(size_list)
-    import pickle
-
-    pickle.dump(documents, open("./data/tf_balanced_train.p", "wb"))
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+from multiprocessing import Pool
+
+TWEET_TOKENIZER = 'tweet'
+SENTENCE_TOKENIZER = 'sentence'
+WORD_TOKENIZER = 'word'
+
+TOKEN_CACHE_FILE = './data/cache/tokens.sqlite'
+TOKENIZE_CHUNK_SIZE = 5000
+SQLITE_MAX_VARIABLES = 900
+# stage workers share the cache file, a writer waits this many seconds for another one's transaction to finish
+TOKEN_CACHE_TIMEOUT = 60
+TOKEN_CACHE_WRITE_BATCH = 1000
+
+
+def get_tokenize_function(tokenizer_name):
+    if tokenizer_name == TWEET_TOKENIZER:
+        from nltk.tokenize import TweetTokenizer
+        return TweetTokenizer().tokenize
+    elif tokenizer_name == SENTENCE_TOKENIZER:
+        from nltk import sent_tokenize
+        return sent_tokenize
+    elif tokenizer_name == WORD_TOKENIZER:
+        from nltk import word_tokenize
+        return word_tokenize
+    raise ValueError("unknown tokenizer {}".format(tokenizer_name))
+
+
+def tokenize_chunk(args):
+    tokenizer_name, texts = args
+    tokenize = get_tokenize_function(tokenizer_name)
+    return [tokenize(text) for text in texts]
+
+
+def text_key(tokenizer_name, text):
+    return hashlib.sha1((tokenizer_name + '\0' + text).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class TokenCache(object):
+    """On-disk token cache, one pickled token list per (tokenizer, comment text) hash."""
+
+    def __init__(self, cache_file=TOKEN_CACHE_FILE):
+        os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(cache_file, timeout=TOKEN_CACHE_TIMEOUT)
+        # readers do not block on a writer and the other way round
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens BLOB)")
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            batch = keys[i:i + SQLITE_MAX_VARIABLES]
+            query = "SELECT key, tokens FROM tokens WHERE key IN ({})".format(",".join("?" * len(batch)))
+            for key, tokens in self.connection.execute(query, batch):
+                found[key] = pickle.loads(tokens)
+        return found
+
+    def put_many(self, items):
+        # short transactions, so other workers writing to the cache do not wait for a whole corpus
+        items = list(items)
+        for i in range(0, len(items), TOKEN_CACHE_WRITE_BATCH):
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO tokens VALUES (?, ?)",
+                                            ((key, pickle.dumps(tokens, protocol=pickle.HIGHEST_PROTOCOL))
+                                             for key, tokens in items[i:i + TOKEN_CACHE_WRITE_BATCH]))
+
+    def close(self):
+        self.connection.close()
+
+
+def tokenize_corpus(texts, tokenizer_name=TWEET_TOKENIZER, n_jobs=None, chunk_size=TOKENIZE_CHUNK_SIZE,
+                    cache_file=TOKEN_CACHE_FILE):
+    """
+    tokenize a corpus across a process pool, skipping every text already in the token cache
+
+    :param texts: texts to tokenize
+    :type texts: iterable of str
+    :param tokenizer_name: one of TWEET_TOKENIZER, SENTENCE_TOKENIZER, WORD_TOKENIZER
+    :param n_jobs: number of worker processes, None uses every core, 1 tokenizes in this process
+    :param chunk_size: number of texts sent to a worker at once
+    :param cache_file: sqlite file to memoise results in, None disables the cache
+    :return: token list per text, in the order of texts
+    :rtype: list of list of str
+    """
+    texts = list(texts)
+    keys = [text_key(tokenizer_name, text) for text in texts]
+    cache = TokenCache(cache_file) if cache_file else None
+    tokenized = cache.get_many(set(keys)) if cache else {}
+
+    # identical comments (e.g. overlapping train/test rows) are only tokenized once
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in tokenized and key not in missing:
+            missing[key] = text
+    if missing:
+        missing_keys = list(missing)
+        missing_texts = [missing[key] for key in missing_keys]
+        text_chunks = [(tokenizer_name, missing_texts[i:i + chunk_size])
+                       for i in range(0, len(missing_texts), chunk_size)]
+        if n_jobs == 1 or len(text_chunks) == 1:
+            results = map(tokenize_chunk, text_chunks)
+            missing_tokens = [tokens for chunk in results for tokens in chunk]
+        else:
+            with Pool(n_jobs) as pool:
+                missing_tokens = [tokens for chunk in pool.imap(tokenize_chunk, text_chunks) for tokens in chunk]
+        new_items = list(zip(missing_keys, missing_tokens))
+        tokenized.update(new_items)
+        if cache:
+            cache.put_many(new_items)
+    if cache:
+        cache.close()
+    return [tokenized[key] for key in keys]
@@ -0,0 +1,241 @@
+import csv
+import os
+import pickle
+import time
+
+import numpy as np
+from keras.models import load_model
+from keras.preprocessing import sequence
+
+from feature_assembly import SparseBatchSequence, wide_feature_blocks, WIDE_BATCH_SIZE
+from gazette_model import match_gazette
+from instrumentation import timed
+from lda_model import predict_lda_topics
+from lsi_model import predict_LSI_model
+from lstm_model import lstm_predict, rebind_w2v_embedding, w2v_embedding_row_writer, MAX_NUM_WORDS_ONE_HOT, \
+    PREDICT_BATCH_SIZE
+from tf_idf_model import transform_tf_idf_big, score_stacked_logistic_regression
+from transformer_registry import TransformerRegistry, TF_IDF_CHAR_TRANSFORMER, TF_IDF_WORD_TRANSFORMER, \
+    TF_IDF_LR_STACKED_TRANSFORMER, LSI_TRANSFORMER, LDA_TRANSFORMER, LDA_VECTORIZER_TRANSFORMER, \
+    KERAS_TOKENIZER_TRANSFORMER
+from utils import tokenize_sentences, tokens_to_w2v_indices, transform_text_in_df_return_w2v_np_vectors, \
+    build_w2v_embedding_matrix, build_w2v_word_index, iter_data_chunks, ID_INDEX, COMMENT_TEXT_INDEX
+
+PIPELINE_CHUNK_SIZE = 10000
+# embedding rows kept free for the words of a batch that were not in the training vocabulary
+W2V_SPARE_EMBEDDING_ROWS = 100000
+
+PIPELINE_FILE_NAME = "pipeline.p"
+W2V_MODEL_PREFIX = "w2v_"
+NOVEL_MODEL_PREFIX = "novel_"
+WIDE_MODEL_PREFIX = "wide_"
+KERAS_MODEL_SUFFIX = ".h5"
+
+
+class ToxicityPipeline(object):
+    """
+    Every fitted artifact of the deep and wide model, loaded once, scoring raw comments batch by batch.
+
+    The tokenizer, TF-IDF, logistic regression, LSI and LDA transformers are read from a TransformerRegistry by the
+    fingerprints they were trained with, so a registry that does not match the trained models is refused.
+
+    Nothing is refitted at prediction time. For w2v index models the words of a batch that are missing from the
+    training vocabulary are written into spare rows of the frozen embedding (W2V_SPARE_EMBEDDING_ROWS), so the
+    GRUs keep their cached feature extractors instead of being rebuilt for every batch.
+    """
+
+    def __init__(self, labels, w2v_model, w2v_model_dict, w2v_vocabulary, novel_model_dict, registry, fingerprints,
+                 wide_model_dict, gazette_index, bucketed=False, batch_size=PREDICT_BATCH_SIZE, logger=None):
+        """
+        :param labels: labels the wide models were trained for, the order of the predicted columns
+        :param w2v_vocabulary: vocabulary the w2v GRU ids refer to, None for GRUs trained on w2v vectors
+        :param registry: TransformerRegistry holding the fitted transformers
+        :param fingerprints: registry name -> fingerprint of the entry the pipeline uses
+        :param gazette_index: the index the wide models' gazette columns were built with, not the current one
+        """
+        self.labels = list(labels)
+        self.w2v_model = w2v_model
+        self.w2v_vocabulary = w2v_vocabulary
+        self.novel_model_dict = novel_model_dict
+        self.registry = registry
+        self.fingerprints = dict(fingerprints)
+        self.tokenizer = self.load_transformer(KERAS_TOKENIZER_TRANSFORMER)
+        self.vect_char = self.load_transformer(TF_IDF_CHAR_TRANSFORMER)
+        self.vect_word = self.load_transformer(TF_IDF_WORD_TRANSFORMER)
+        # (coefficients, intercepts, keys) from export_stacked_logistic_regression
+        self.lr_stacked = self.load_transformer(TF_IDF_LR_STACKED_TRANSFORMER)
+        self.lsi_featurizer = self.load_transformer(LSI_TRANSFORMER)
+        self.lda_model = self.load_transformer(LDA_TRANSFORMER)
+        self.lda_vectorizer = self.load_transformer(LDA_VECTORIZER_TRANSFORMER)
+        self.wide_model_dict = wide_model_dict
+        self.gazette_index = gazette_index
+        self.bucketed = bucketed
+        self.batch_size = batch_size
+        self.logger = logger
+        # saved as trained, the spare embedding rows are added again on load
+        self.trained_w2v_model_dict = w2v_model_dict
+        self.w2v_model_dict = w2v_model_dict
+        self.embedding_writers = []
+        self.w2v_word_index = None
+        if w2v_vocabulary is not None:
+            # built once, every batch only looks its words up in it
+            self.w2v_word_index = build_w2v_word_index(w2v_vocabulary)
+            embedding_matrix = build_w2v_embedding_matrix(w2v_vocabulary, w2v_model)
+            embedding_matrix = np.vstack((embedding_matrix, np.zeros((W2V_SPARE_EMBEDDING_ROWS,
+                                                                      embedding_matrix.shape[1]),
+                                                                     dtype=embedding_matrix.dtype)))
+            self.w2v_model_dict = {name: rebind_w2v_embedding(model, embedding_matrix)
+                                   for name, model in w2v_model_dict.items()}
+            self.embedding_writers = [w2v_embedding_row_writer(model) for model in self.w2v_model_dict.values()]
+
+    def load_transformer(self, name):
+        return self.registry.load(name, self.fingerprints[name])
+
+    def w2v_input(self, texts):
+        if self.w2v_vocabulary is None:
+            return transform_text_in_df_return_w2v_np_vectors(texts, self.w2v_model, n_jobs=1, cache_file=None)
+        known_words = len(self.w2v_word_index)
+        ids, new_words = tokens_to_w2v_indices(tokenize_sentences(texts, n_jobs=1, cache_file=None), self.w2v_model,
+                                               self.w2v_word_index)
+        if len(new_words) > W2V_SPARE_EMBEDDING_ROWS:
+            if self.logger:
+                self.logger.warning("%s new words in batch, the %s without a spare embedding row are dropped",
+                                    len(new_words), len(new_words) - W2V_SPARE_EMBEDDING_ROWS)
+            ids[ids > known_words + W2V_SPARE_EMBEDDING_ROWS] = 0
+            new_words = new_words[:W2V_SPARE_EMBEDDING_ROWS]
+        if new_words:
+            # new word i has id known_words + 1 + i, row 0 of the matrix is padding
+            vectors = build_w2v_embedding_matrix(new_words, self.w2v_model)[1:]
+            for write in self.embedding_writers:
+                write(known_words + 1, vectors)
+        return ids
+
+    def predict_batch(self, texts):
+        """
+        :param texts: raw comments
+        :return: probability of every label, columns in the order of self.labels
+        :rtype: numpy.ndarray of shape (len(texts), len(self.labels))
+        """
+        texts = list(texts)
+        rows = len(texts)
+        # no logger, a line per featurizer and chunk would drown the log, the timings go to the run report
+        # the tokenizers run in this process (n_jobs=1): a pool per chunk would fork a process holding the tensorflow
+        # session and every model, and its startup is not paid back on a chunk of PIPELINE_CHUNK_SIZE rows
+        with timed("gazette match", rows=rows):
+            gazette = match_gazette(self.gazette_index, texts, cache_file=None, n_jobs=1)
+        with timed("w2v input", rows=rows):
+            w2v_input = self.w2v_input(texts)
+        w2v_results = lstm_predict(model_dict=self.w2v_model_dict, predicted_data=w2v_input,
+                                   truth_dictionary=self.labels, use_w2v=True, bucketed=self.bucketed,
+                                   batch_size=self.batch_size)
+        with timed("tokenizer transform", rows=rows):
+            padded_text = sequence.pad_sequences(self.tokenizer.texts_to_sequences(texts),
+                                                 maxlen=MAX_NUM_WORDS_ONE_HOT)
+        # same input dtype as the novel features the wide models were trained on
+        novel_results = lstm_predict(model_dict=self.novel_model_dict, predicted_data=padded_text,
+                                     truth_dictionary=self.labels, use_w2v=False, bucketed=self.bucketed,
+                                     batch_size=self.batch_size)
+        with timed("lsi topics", rows=rows):
+            lsi_topics = predict_LSI_model(self.lsi_featurizer, texts)
+        with timed("lda topics", rows=rows):
+            lda_topics = predict_lda_topics(self.lda_model, texts, self.lda_vectorizer)
+        lr_coefficients, lr_intercepts, lr_keys = self.lr_stacked
+        with timed("tf-idf logistic regression", rows=rows):
+            lr_probabilities = score_stacked_logistic_regression(
+                transform_tf_idf_big(texts, self.vect_char, self.vect_word), lr_coefficients, lr_intercepts)
+        lr_columns = {key: column for column, key in enumerate(lr_keys)}
+
+        probabilities = np.empty((len(texts), len(self.labels)), dtype='float32')
+        for column, key in enumerate(self.labels):
+            with timed("wide predict " + key, rows=rows):
+                lr_column = lr_columns[key]
+                wide_features = wide_feature_blocks(gazette, w2v_results[key], novel_results[key], lsi_topics,
+                                                    lda_topics, lr_probabilities[:, lr_column:lr_column + 1])
+                prediction_sequence = SparseBatchSequence(wide_features, batch_size=WIDE_BATCH_SIZE)
+                probabilities[:, column] = self.wide_model_dict[key].predict_generator(
+                    prediction_sequence, steps=len(prediction_sequence))[:, 0]
+        return probabilities
+
+    def predict_file(self, data_file, output_file, chunk_size=PIPELINE_CHUNK_SIZE):
+        """
+        stream a csv of comments through the pipeline, only chunk_size rows are held at a time
+
+        :param data_file: csv with id and comment_text columns
+        :param output_file: csv written with an id column and one probability column per label
+        :return: number of rows scored
+        """
+        number_of_rows = 0
+        start = time.time()
+        with open(output_file, "w", newline='') as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerow([ID_INDEX] + self.labels)
+            for chunk in iter_data_chunks(data_file, chunksize=chunk_size):
+                probabilities = self.predict_batch(chunk[COMMENT_TEXT_INDEX])
+                csv_writer.writerows([comment_id] + row for comment_id, row in zip(chunk[ID_INDEX],
+                                                                                    probabilities.tolist()))
+                f.flush()
+                number_of_rows += len(chunk)
+                if self.logger:
+                    self.logger.info("scored %s rows, %.0f rows/sec", number_of_rows,
+                                     number_of_rows / max(time.time() - start, 1e-9))
+        return number_of_rows
+
+    def save(self, directory):
+        """the transformers stay in the registry, the pipeline keeps its path relative to directory"""
+        os.makedirs(directory, exist_ok=True)
+        for prefix, model_dict in ((W2V_MODEL_PREFIX, self.trained_w2v_model_dict),
+                                   (NOVEL_MODEL_PREFIX, self.novel_model_dict),
+                                   (WIDE_MODEL_PREFIX, self.wide_model_dict)):
+            for name, model in model_dict.items():
+                model.save(os.path.join(directory, prefix + name + KERAS_MODEL_SUFFIX))
+        with open(os.path.join(directory, PIPELINE_FILE_NAME), "wb") as f:
+            pickle.dump({'labels': self.labels, 'w2v_vocabulary': self.w2v_vocabulary,
+                         'registry_directory': os.path.relpath(self.registry.directory, directory),
+                         'fingerprints': self.fingerprints, 'gazette_index': self.gazette_index,
+                         'bucketed': self.bucketed, 'batch_size': self.batch_size,
+                         'w2v_models': list(self.trained_w2v_model_dict), 'novel_models': list(self.novel_model_dict),
+                         'wide_models': list(self.wide_model_dict)}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, directory, w2v_model, logger=None):
+        """
+        :param w2v_model: the w2v model (or embedding store) the pipeline was trained with, it is not saved with it
+        """
+        state = load_pipeline_state(directory)
+
+        def load_models(prefix, names):
+            return {name: load_model(os.path.join(directory, prefix + name + KERAS_MODEL_SUFFIX)) for name in names}
+
+        return cls(labels=state['labels'], w2v_model=w2v_model,
+                   w2v_model_dict=load_models(W2V_MODEL_PREFIX, state['w2v_models']),
+                   w2v_vocabulary=state['w2v_vocabulary'],
+                   novel_model_dict=load_models(NOVEL_MODEL_PREFIX, state['novel_models']),
+                   registry=TransformerRegistry(os.path.join(directory, state['registry_directory'])),
+                   fingerprints=state['fingerprints'],
+                   wide_model_dict=load_models(WIDE_MODEL_PREFIX, state['wide_models']),
+                   gazette_index=state['gazette_index'], bucketed=state['bucketed'],
+                   batch_size=state['batch_size'], logger=logger)
+
+
+def load_pipeline_state(directory):
+    """everything a saved pipeline keeps besides its keras models"""
+    with open(os.path.join(directory, PIPELINE_FILE_NAME), "rb") as f:
+        return pickle.load(f)
+
+
+def pipeline_registry(directory):
+    """
+    :return: the registry a saved pipeline reads its transformers from and the fingerprints it reads them by,
+     without loading any model
+    :rtype: TransformerRegistry, dict
+    """
+    state = load_pipeline_state(directory)
+    return TransformerRegistry(os.path.join(directory, state['registry_directory'])), state['fingerprints']
+
+
+def update_pipeline_fingerprints(directory, fingerprints):
+    """point a saved pipeline at updated registry entries, e.g. after incremental_update.refresh_models"""
+    state = load_pipeline_state(directory)
+    state['fingerprints'] = dict(fingerprints)
+    with open(os.path.join(directory, PIPELINE_FILE_NAME), "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+
+REGISTRY_VERSION = 1
+
+TF_IDF_CHAR_TRANSFORMER = "tf_idf_char"
+TF_IDF_WORD_TRANSFORMER = "tf_idf_word"
+TF_IDF_LR_TRANSFORMER = "tf_idf_lr"
+TF_IDF_LR_STACKED_TRANSFORMER = "tf_idf_lr_stacked"
+LSI_TRANSFORMER = "lsi"
+LDA_TRANSFORMER = "lda"
+LDA_VECTORIZER_TRANSFORMER = "lda_vectorizer"
+KERAS_TOKENIZER_TRANSFORMER = "keras_tokenizer"
+
+
+def fingerprint_texts(texts, **params):
+    """
+    :param texts: the data a transformer is fitted on
+    :param params: any hyperparameters that should invalidate a saved transformer when they change
+    :return: sha1 hex digest of the texts and params
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    for text in texts:
+        sha1.update(text.encode('utf-8', 'surrogatepass'))
+        sha1.update(b'\0')
+    sha1.update(repr(sorted(params.items())).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def combine_fingerprints(*fingerprints):
+    """fingerprint of a transformer fitted on one dataset and then updated with further batches, in order"""
+    return hashlib.sha1('\0'.join(fingerprints).encode('utf-8')).hexdigest()
+
+
+class TransformerRegistry(object):
+    """
+    Directory of fitted transformers, saved once at training time and reloaded for transform-only use.
+
+    Every entry is a pickle of the fitted object plus a small json header with its version and the fingerprint of
+    the data it was fitted on, so a stale or mismatched transformer is refused instead of silently used.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _pickle_path(self, name):
+        return os.path.join(self.directory, name + ".p")
+
+    def _header_path(self, name):
+        return os.path.join(self.directory, name + ".json")
+
+    def header(self, name):
+        if not os.path.exists(self._header_path(name)):
+            return None
+        with open(self._header_path(name)) as f:
+            return json.load(f)
+
+    def has(self, name, fingerprint=None, version=REGISTRY_VERSION):
+        header = self.header(name)
+        if header is None or header['version'] != version:
+            return False
+        return fingerprint is None or header['fingerprint'] == fingerprint
+
+    def save(self, name, transformer, fingerprint, version=REGISTRY_VERSION):
+        with open(self._pickle_path(name), 'wb') as f:
+            pickle.dump(transformer, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # header last, an entry only counts as saved once its header exists
+        with open(self._header_path(name), 'w') as f:
+            json.dump({'name': name, 'version': version, 'fingerprint': fingerprint,
+                       'created': time.strftime("%Y-%m-%d %H:%M:%S")}, f)
+        return transformer
+
+    def load(self, name, fingerprint=None, version=REGISTRY_VERSION):
+        header = self.header(name)
+        if header is None:
+            raise KeyError("no fitted transformer {} in {}".format(name, self.directory))
+        if not self.has(name, fingerprint, version):
+            raise ValueError("transformer {} was saved with version {} fingerprint {}, expected version {} "
+                             "fingerprint {}".format(name, header['version'], header['fingerprint'], version,
+                                                     fingerprint))
+        with open(self._pickle_path(name), 'rb') as f:
+            return pickle.load(f)
@@ -1,9 +1,13 @@
 import numpy as np
 import pandas as pd
+import hashlib
 import logging
+import os
 from gensim.models import KeyedVectors
 from keras.preprocessing import sequence
-from nltk.tokenize import TweetTokenizer
+
+from tokenization import tokenize_corpus, TWEET_TOKENIZER, TOKEN_CACHE_FILE
+from embedding_store import compile_w2v_model_to_store, is_embedding_store, load_embedding_store
 
 
 MAX_W2V_LENGTH = 300
@@ -13,6 +17,7 @@ X_TEST_DATA_INDEX = 1
 Y_TRAIN_DATA_INDEX = 2
 Y_TEST_DATA_INDEX = 3
 
+ID_INDEX = 'id'
 COMMENT_TEXT_INDEX = 'comment_text'
 TOXIC_TEXT_INDEX = 'toxic'
 SEVERE_TOXIC_TEXT_INDEX = 'severe_toxic'
@@ -26,20 +31,32 @@ TRUTH_LABELS = [TOXIC_TEXT_INDEX, SEVERE_TOXIC_TEXT_INDEX, OBSCENE_TEXT_INDEX, T
 DATA_FILE = './data/train.csv'
 BALANCED_DATA_FILE = './data/balanced_train_file.csv'
 W2V_MODEL = './models/w2v.840B.300d.txt'
+W2V_STORE = './models/w2v.840B.300d.store/'
+DATA_CACHE_DIRECTORY = './data/cache/'
+DATA_CHUNK_SIZE = 50000
+# labels only exist in the train files, dtypes for missing columns are ignored by read_csv
+DATA_DTYPES = dict([(ID_INDEX, str), (COMMENT_TEXT_INDEX, str)] + [(label, 'int8') for label in TRUTH_LABELS])
 
 
-def load_data(data_file, type='pd'):
+def load_data(data_file, type='pd', use_cache=True, cache_directory=DATA_CACHE_DIRECTORY):
     """
 
     :param data_file: path to train data file
     :type data_file: str
+    :param use_cache: reuse (or write) a columnar copy of the parsed file, keyed by the file's content hash
+    :type use_cache: bool
     :return: list of strings [text_data] containing each row of text in traing dataset, and
      dictionary of truth labels with key as dataset name and value as a list containing labels for each row in text_data
     :rtype: full_truth_labels_data : dictionary of lists of ints,  text_data : list of str
     """
     if type == 'pd':
-        df = pd.read_csv(data_file)
-
+        if not use_cache:
+            return read_typed_csv(data_file)
+        cache_path = os.path.join(cache_directory, "{}.{}".format(os.path.basename(data_file), hash_file(data_file)))
+        df = load_cached_dataframe(cache_path)
+        if df is None:
+            df = read_typed_csv(data_file)
+            save_cached_dataframe(df, cache_path)
         return df
     else:
         import csv
@@ -52,6 +69,48 @@ def load_data(data_file, type='pd'):
         return header, return_list
 
 
+def read_typed_csv(data_file, chunksize=None):
+    """
+    :param data_file: path to a train/test csv
+    :type data_file: str
+    :param chunksize: if given, return an iterator of DataFrames of this many rows instead of one DataFrame
+    :type chunksize: int
+    :return: DataFrame with string ids/comments and int8 labels
+    """
+    # na_filter=False keeps comments such as "NA" or "" as strings instead of turning them into NaN
+    return pd.read_csv(data_file, dtype=DATA_DTYPES, na_filter=False, chunksize=chunksize)
+
+
+def iter_data_chunks(data_file, chunksize=DATA_CHUNK_SIZE):
+    """Yield successive typed DataFrames of at most chunksize rows, for files that do not fit in memory."""
+    for chunk in read_typed_csv(data_file, chunksize=chunksize):
+        yield chunk
+
+
+def hash_file(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def load_cached_dataframe(cache_path):
+    if os.path.exists(cache_path + '.parquet'):
+        return pd.read_parquet(cache_path + '.parquet')
+    if os.path.exists(cache_path + '.p'):
+        return pd.read_pickle(cache_path + '.p')
+    return None
+
+
+def save_cached_dataframe(df, cache_path):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    try:
+        df.to_parquet(cache_path + '.parquet')
+    except ImportError:  # no pyarrow/fastparquet installed, pickle is still far faster than re-parsing the csv
+        df.to_pickle(cache_path + '.p')
+
+
 def dataframe_to_list(df):
     """
 
@@ -97,14 +156,14 @@ def vectorize_text_if_possible_else_return_None(tokenized_sentence, model):
         return my_array
 
 
-def tokenize_sentences(list_of_sentences):
-    tknzr = TweetTokenizer()
-    # tokenize sentences
-    return [i for i in map(lambda x: tknzr.tokenize(x), list_of_sentences)]
+def tokenize_sentences(list_of_sentences, n_jobs=None, cache_file=TOKEN_CACHE_FILE):
+    # tokenize sentences across a process pool, reusing cached tokens of previously seen comments
+    # cache_file=None for comments that are only seen once, e.g. at prediction time
+    return tokenize_corpus(list_of_sentences, TWEET_TOKENIZER, n_jobs=n_jobs, cache_file=cache_file)
 
 
-def transform_text_in_df_return_w2v_np_vectors(list_of_sentences, w2v_model):
-    list_of_sentences = tokenize_sentences(list_of_sentences)
+def transform_text_in_df_return_w2v_np_vectors(list_of_sentences, w2v_model, n_jobs=None, cache_file=TOKEN_CACHE_FILE):
+    list_of_sentences = tokenize_sentences(list_of_sentences, n_jobs=n_jobs, cache_file=cache_file)
     list_of_sentences = vectorise_tweets(w2v_model, list_of_sentences)
     list_of_sentences = drop_words_with_no_vectors_at_all_in_w2v(
         list_of_sentences)  # because some text return nothing, must remove ground truth too
@@ -116,6 +175,78 @@ def transform_text_in_df_return_w2v_np_vectors(list_of_sentences, w2v_model):
     return np_text_array
 
 
+def transform_text_in_df_return_w2v_indices(list_of_sentences, w2v_model, vocabulary=None, n_jobs=None):
+    """
+    compact alternative to transform_text_in_df_return_w2v_np_vectors, emits embedding row ids instead of vectors
+
+    :param list_of_sentences: sentences to transform
+    :type list_of_sentences: list of str
+    :param w2v_model: w2v model used to decide which words have vectors
+    :type w2v_model: KeyedVectors or MemmapKeyedVectors
+    :param vocabulary: words already assigned ids (id = position + 1), new words are appended to a copy
+    :type vocabulary: list of str
+    :param n_jobs: tokenizer processes, None for one per core
+    :return: pre-padded id matrix of shape (N, MAX_W2V_LENGTH), 0 is padding, and the vocabulary the ids refer to
+    :rtype: np.ndarray of int32, list of str
+    """
+    vocabulary = list(vocabulary) if vocabulary is not None else []
+    np_index_array, new_words = tokens_to_w2v_indices(tokenize_sentences(list_of_sentences, n_jobs=n_jobs),
+                                                      w2v_model, build_w2v_word_index(vocabulary))
+    return np_index_array, vocabulary + new_words
+
+
+def build_w2v_word_index(vocabulary):
+    """:return: word -> embedding row id of a vocabulary returned by transform_text_in_df_return_w2v_indices"""
+    return {word: index + 1 for index, word in enumerate(vocabulary)}
+
+
+def tokens_to_w2v_indices(tokenized_sentences, w2v_model, word_index):
+    """
+    :param tokenized_sentences: token lists, e.g. from tokenize_sentences
+    :param word_index: word -> id of the words already assigned one, it is not modified
+    :type word_index: dict
+    :return: pre-padded id matrix of shape (N, MAX_W2V_LENGTH), 0 is padding, and the words with a vector that are
+     missing from word_index, the i-th one has id len(word_index) + 1 + i
+    :rtype: np.ndarray of int32, list of str
+    """
+    first_new_id = len(word_index) + 1
+    new_words = []
+    new_word_index = {}
+    np_index_array = np.zeros((len(tokenized_sentences), MAX_W2V_LENGTH), dtype='int32')
+    for row, tokenized_sentence in enumerate(tokenized_sentences):
+        indices = []
+        for word in tokenized_sentence:
+            # every word in word_index has a vector, only the others are looked up in the model
+            index = word_index.get(word)
+            if index is None and word in w2v_model.vocab:
+                index = new_word_index.get(word)
+                if index is None:
+                    index = new_word_index[word] = first_new_id + len(new_words)
+                    new_words.append(word)
+            if index is not None:
+                indices.append(index)
+        # same as pad_sequences defaults, keep the last MAX_W2V_LENGTH words and pad at the front
+        indices = indices[-MAX_W2V_LENGTH:]
+        if indices:
+            np_index_array[row, -len(indices):] = indices
+    return np_index_array, new_words
+
+
+def build_w2v_embedding_matrix(vocabulary, w2v_model):
+    """
+    :param vocabulary: vocabulary returned by transform_text_in_df_return_w2v_indices
+    :type vocabulary: list of str
+    :param w2v_model: w2v model to take the vectors from
+    :type w2v_model: KeyedVectors or MemmapKeyedVectors
+    :return: embedding matrix of shape (len(vocabulary) + 1, vector size), row 0 is the all zero padding vector
+    :rtype: np.ndarray of float32
+    """
+    embedding_matrix = np.zeros((len(vocabulary) + 1, w2v_model.vector_size), dtype='float32')
+    for index, word in enumerate(vocabulary):
+        embedding_matrix[index + 1] = w2v_model[word]
+    return embedding_matrix
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
@@ -130,15 +261,21 @@ def extract_truth_labels_as_dict(df):
     return dictionary_of_truth_labels
 
 
-def load_w2v_model_from_path(model_path, binary_input=False):
+def load_w2v_model_from_path(model_path, binary_input=False, store_path=None):
     """
     :param model_path: path to w2v model
     :type model_path: string
     :param binary_input: True : binary input, False : text input
     :type binary_input: boolean
+    :param store_path: directory of the memory-mapped embedding store, compiled from model_path on first use
+    :type store_path: string
     :return: loaded w2v model
-    :rtype: KeyedVectors object
+    :rtype: KeyedVectors object, or MemmapKeyedVectors if store_path is given
     """
+    if store_path is not None:
+        if not is_embedding_store(store_path):
+            compile_w2v_model_to_store(model_path, store_path, binary_input=binary_input)
+        return load_embedding_store(store_path)
     w2v_model = KeyedVectors.load_word2vec_format(model_path, binary=binary_input)
     return w2v_model
 